@@ -0,0 +1,122 @@
+''' Measures throughput and peak memory of collate, summary and delta stages on synthetic data. '''
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+from synthetic_data import generate_pair, synthetic_properties
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+STAGES = ['collate', 'collate_incremental', 'summaries', 'delta']
+DATE_STR = '2021-05-11'
+
+
+def run_stage(stage: str, config: dict, previous: str, date_str: str) -> dict:
+    ''' Runs a stage in this (fresh) process and returns its timing and peak memory. '''
+
+    import collate_data
+    import process_delta
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    if stage == 'collate':
+        collate_data.excel_to_csv(previous, config)
+    elif stage == 'collate_incremental':
+        collate_data.excel_to_csv(date_str, config)
+    elif stage == 'summaries':
+        collate_data.create_summaries(date_str, config)
+    elif stage == 'delta':
+        data_dir = config['download_dir']
+        process_delta.process_delta_csv(os.path.join(data_dir, date_str, f"{date_str}_consolidated_data.csv"),
+                                        os.path.join(data_dir, previous, f"{previous}_consolidated_data.csv"),
+                                        date_str, data_dir, config)
+    return {'wall_s': round(time.perf_counter() - wall, 4), 'cpu_s': round(time.process_time() - cpu, 4),
+            'peak_rss_mb': instrumentation.peak_rss_mb()}
+
+
+def benchmark_size(num_rows: int, args) -> dict:
+    ''' Generates a day pair of num_rows rows each and measures every stage in its own process. '''
+
+    download_dir = tempfile.mkdtemp(prefix=f'bench_{num_rows}_', dir=args.workdir)
+    properties = synthetic_properties(args.properties)
+    rows_per_month = max(num_rows // (args.properties * args.months), 1)
+    logger.info(f"Generating {num_rows} rows in {download_dir}")
+    previous, date_str = generate_pair(download_dir, DATE_STR, properties, args.months, rows_per_month,
+                                       args.change_rate, seed=args.seed)
+    config = {'download_dir': download_dir, 'start_month_offset': 0, 'end_month_offset': args.months - 1,
+              'parse_workers': args.parse_workers, 'incremental_collation': True}
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for stage in STAGES:
+        # A fresh process per stage so that peak RSS belongs to that stage alone
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_stage, stage, config, previous, date_str).result()
+        result['rows'] = rows_per_month * args.properties * args.months
+        result['rows_per_s'] = round(result['rows'] / result['wall_s'], 1) if result['wall_s'] else None
+        results[stage] = result
+        logger.info(f"{num_rows} rows {stage}: {result}")
+
+    if not args.keep_data:
+        shutil.rmtree(download_dir)
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    ''' Returns stages slower or using more memory than baseline by more than tolerance. '''
+
+    regressions = []
+    for size, stages in results.items():
+        for stage, result in stages.items():
+            base = baseline.get(size, {}).get(stage)
+            if not base:
+                continue
+            if base.get('rows_per_s') and result['rows_per_s'] < base['rows_per_s'] * (1 - tolerance):
+                regressions.append(f"{stage} at {size} rows: {result['rows_per_s']} rows/s, baseline {base['rows_per_s']}")
+            if base.get('peak_rss_mb') and result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+                regressions.append(f"{stage} at {size} rows: {result['peak_rss_mb']} MB, baseline {base['peak_rss_mb']}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--properties', type=int, default=3)
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--change-rate', type=float, default=0.05)
+    parser.add_argument('--parse-workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help='directory for generated data, system temp by default')
+    parser.add_argument('--keep-data', action='store_true', help='keep generated workbooks and outputs')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown or memory growth')
+    parser.add_argument('--save-baseline', action='store_true', help='store results as new baseline')
+    args = parser.parse_args()
+
+    results = {str(size): benchmark_size(size, args) for size in args.sizes}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Saved results to {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Saved results as baseline {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            logger.error(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        logger.info("No regressions against baseline")
@@ -0,0 +1,87 @@
+''' Checkpoints of the stages of a day's run, so that a rerun resumes at the first stage left to do. '''
+
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+
+from partition_manifest import file_hash
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+STAGES = ['download', 'verify', 'collate', 'delta', 'upload']
+# Settings the outputs of each stage depend on, changing one of them runs the stage again
+STAGE_SETTINGS = {
+    'download': ('properties', 'start_month_offset', 'end_month_offset'),
+    'verify': ('properties', 'start_month_offset', 'end_month_offset'),
+    'collate': ('properties', 'start_month_offset', 'end_month_offset', 'compact_schema', 'output_codec',
+                'summaries', 'history_store'),
+    'delta': ('start_month_offset', 'end_month_offset', 'compact_schema', 'output_codec'),
+    'upload': ('bucket_name',),
+}
+# Bump when stages write different outputs for the same inputs
+CHECKPOINT_VERSION = 1
+
+
+def checkpoint_path(date_str: str, config: dict) -> str:
+    return os.path.join(config['download_dir'], date_str, f"{date_str}_checkpoints.json")
+
+
+def value_fingerprint(value) -> str:
+    ''' Returns sha256 of a json serializable value, e.g. the config a stage depends on. '''
+
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def settings_fingerprint(stage: str, config: dict) -> str:
+    ''' Returns fingerprint of the settings of config a stage depends on, not e.g. login details. '''
+
+    return value_fingerprint({key: config.get(key) for key in STAGE_SETTINGS[stage]})
+
+
+def file_fingerprints(paths) -> dict:
+    ''' Returns sha256 of every given file, None for files that do not exist. '''
+
+    return {path: file_hash(path) if os.path.exists(path) else None for path in paths}
+
+
+class Checkpoints:
+    ''' Inputs and outputs of every finished stage of a date, saved after each stage. '''
+
+    def __init__(self, date_str: str, config: dict, force=()):
+        self.path = checkpoint_path(date_str, config)
+        self.force = set(STAGES) if 'all' in force else set(force)
+        self.enabled = config.get('checkpoints', True)
+        self.stages = {}
+        if self.enabled and os.path.exists(self.path):
+            with open(self.path) as f:
+                checkpoints = json.load(f)
+            if checkpoints.get('version') == CHECKPOINT_VERSION:
+                self.stages = checkpoints['stages']
+
+    def is_done(self, stage: str, inputs: dict) -> bool:
+        ''' Checks if stage finished before with the same inputs and its outputs are still as it left them. '''
+
+        if not self.enabled or stage in self.force:
+            return False
+        checkpoint = self.stages.get(stage)
+        if checkpoint is None:
+            return False
+        if checkpoint['inputs'] != inputs:
+            logger.info(f"Inputs of {stage} stage changed since its checkpoint")
+            return False
+        if file_fingerprints(checkpoint['outputs']) != checkpoint['outputs']:
+            logger.info(f"Outputs of {stage} stage changed since its checkpoint")
+            return False
+        return True
+
+    def save(self, stage: str, inputs: dict, outputs=()) -> None:
+        if not self.enabled:
+            return
+        self.stages[stage] = {'inputs': inputs, 'outputs': file_fingerprints(outputs),
+                              'finished': datetime.now().isoformat(timespec='seconds')}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({'version': CHECKPOINT_VERSION, 'stages': self.stages}, f, indent=2)
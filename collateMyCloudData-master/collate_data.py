@@ -1,94 +1,292 @@
-import json
 import logging
 import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from typing import List
 
+import numpy as np
 import pandas as pd
 from dateutil.relativedelta import relativedelta
+from openpyxl.utils import get_column_letter
+
+import instrumentation
+from column_schema import AMOUNT_COLUMNS, DATA_TYPES, compact_frame, concat_frames, parse_date_columns
+from columnar_cache import columnar_path, read_consolidated, write_consolidated
+from history_store import append_report
+from output_codec import find_output, write_csv
+from pipeline_context import PipelineContext
+from partition_manifest import (file_hash, load_manifest, partition_path, previous_manifest_date,
+                                save_manifest)
+from summary_settings import configured_summaries
+from verify_download import HEADER_ROWS, WorkbookInfo, probe_workbooks, read_last_row
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def excel_to_csv(date_str: str, config: dict) -> None:
-    ''' Saves a csv file for all excel files in given directory. '''
 
-    # Creating a dict with fixed datatypes for importing excel files.
-    data_types = {'Hotel Name': str, 'External Refrence #': str, 'Confirmation No':  int, 'Account Id':  int, 
-                    'Invoice/Bill No.': str, 'Guest Name': str, 'Reservation Date': str, 'Created By': str, 
-                    'Arrival Date': str, 'Departure Date': str, 'Room Type': str, 'Room no': str, 
-                    'Adult Pax':  int, 'Youth Pax':  int, 'Child Pax':  int, 'Total Pax':  int, 'Reservation Status': str, 
-                    'Confirmation Date': str, 'Reservation Changed on': str, 'Guest Email': str, 
-                    'Guest Contact No': str, 'Guest City': str, 'Guest State': str, 'Guest Country': str, 'Nationality': str, 
-                    'Rate Type': str, 'Booked Thru/Channel': str, 'Business Source': str, 'Market Segment': str, 
-                    'Guest Class': str, 'System Rate': float, 'Agreed Rate': float, 'Date': str, 'Revenue Head': str, 
-                    'Amount': float, 'Discount': float, 'Taxable': float, 'Taxes': float, 'Amount Payable': float}
+# Footer totals are rounded to 2 decimals in the report
+FOOTER_TOLERANCE = 0.01
+
+
+def read_workbook(file: str, compact: bool = False) -> pd.DataFrame:
+    ''' Parses a single excel file with the fixed datatypes and checks it against its footer totals. '''
+
+    df = pd.read_excel(file, skiprows=3, header=1,
+                       index_col=False, engine='openpyxl', dtype=DATA_TYPES, skipfooter=1)
+    check_footer(df, read_footer(file, df.columns), file)
+    return compact_frame(df) if compact else df
+
+
+def read_footer(file: str, columns: pd.Index) -> pd.Series:
+    ''' Returns numeric cells of the footer row of an excel file by column name, NaN for other cells. '''
+
+    row, cells = read_last_row(file)
+    if row <= HEADER_ROWS:
+        raise ValueError(f"{file} has no footer row, download may be truncated")
+    # Columns of the data start at column A of the sheet
+    return pd.Series([cells.get(get_column_letter(x + 1), np.nan) for x in range(len(columns))],
+                     index=columns, dtype=float)
+
+
+def check_footer(df: pd.DataFrame, footer: pd.Series, file: str) -> None:
+    ''' Raises ValueError if summed amounts of a workbook do not match its footer totals. '''
+
+    totals = footer[AMOUNT_COLUMNS].astype(float)
+    sums = df[AMOUNT_COLUMNS].sum()
+    mismatched = [column for column in AMOUNT_COLUMNS
+                  if not abs(sums[column] - totals[column]) <= FOOTER_TOLERANCE]
+    if mismatched:
+        details = ', '.join(f"{column} {sums[column]:.2f} != {totals[column]:.2f}" for column in mismatched)
+        raise ValueError(f"{file} rows do not add up to its footer totals, download may be truncated: {details}")
+
+
+def timed_read_workbook(file: str, compact: bool = False) -> tuple:
+    ''' Parses an excel file and returns it with wall and cpu seconds taken, measured where it ran. '''
+
+    wall, cpu = time.perf_counter(), time.thread_time()
+    frame = read_workbook(file, compact)
+    return frame, time.perf_counter() - wall, time.thread_time() - cpu
+
+
+def read_workbooks(workbooks: List[WorkbookInfo], workers: int = 1, compact: bool = False) -> List[pd.DataFrame]:
+    ''' Parses given excel files, in a process pool if more than one worker is given. '''
+
+    files = [info.file for info in workbooks]
+    if workers > 1 and len(files) > 1:
+        # map keeps the order of files, so output does not depend on which worker finishes first
+        with ProcessPoolExecutor(max_workers=min(workers, len(files))) as executor:
+            results = list(executor.map(timed_read_workbook, files, [compact] * len(files)))
+    else:
+        results = [timed_read_workbook(fl, compact) for fl in files]
+
+    return [parsed_workbook(info, *result) for (info, result) in zip(workbooks, results)]
+
+
+def parsed_workbook(info: WorkbookInfo, frame: pd.DataFrame, wall: float, cpu: float) -> pd.DataFrame:
+    ''' Records parse of a workbook and checks its row count against the probed one. '''
+
+    instrumentation.record_step('parse_workbook', file=os.path.basename(info.file),
+                                wall_s=round(wall, 4), cpu_s=round(cpu, 4), rows_out=len(frame),
+                                bytes_read=instrumentation.file_size(info.file))
+    if info.row_count is not None and info.row_count != len(frame):
+        logger.warning(f"{info.file} has {len(frame)} rows, expected {info.row_count}")
+    return frame
+
+
+def previous_partitions(date_str: str, config: dict) -> dict:
+    ''' Returns manifest entries of latest earlier date, to reuse partitions of unchanged files from. '''
+
+    previous_date = previous_manifest_date(date_str, config)
+    os.makedirs(os.path.dirname(partition_path(date_str, '', config)), exist_ok=True)
+    return load_manifest(previous_date, config) if previous_date else {}
+
+
+def reuse_partition(info: WorkbookInfo, previous: dict, date_str: str, config: dict) -> tuple:
+    ''' Returns manifest entry of an excel file and its partition if it is unchanged, else None for partition. '''
+
+    file_name = os.path.basename(info.file)
+    entry = {'sha256': file_hash(info.file), 'partition': partition_path(date_str, file_name, config)}
+
+    # Copying partition of unchanged file from previous date
+    previous_entry = previous.get(file_name)
+    if not (previous_entry and previous_entry['sha256'] == entry['sha256'] and os.path.exists(previous_entry['partition'])):
+        return entry, None
+    with instrumentation.step('reuse_partition', file=file_name) as record:
+        shutil.copyfile(previous_entry['partition'], entry['partition'])
+        frame = pd.read_parquet(entry['partition'])
+        if config.get('compact_schema', False):
+            frame = compact_frame(frame)
+        record['rows_out'] = len(frame)
+    return entry, frame
+
+
+def read_partitions(date_str: str, config: dict, workbooks: List[WorkbookInfo]) -> List[pd.DataFrame]:
+    ''' Parses only excel files whose content changed since previous manifest and reuses other partitions. '''
+
+    previous = previous_partitions(date_str, config)
+
+    entries = {}
+    frames = [None] * len(workbooks)
+    changed = []
+    for i, info in enumerate(workbooks):
+        entries[os.path.basename(info.file)], frames[i] = reuse_partition(info, previous, date_str, config)
+        if frames[i] is None:
+            changed.append(i)
+    logger.info(f"Reusing {len(workbooks) - len(changed)} partitions, parsing {len(changed)} files")
+
+    # Parsing changed files and saving them as partitions
+    parsed = read_workbooks([workbooks[i] for i in changed], config.get('parse_workers', 1),
+                            config.get('compact_schema', False))
+    for i, frame in zip(changed, parsed):
+        frame.to_parquet(entries[os.path.basename(workbooks[i].file)]['partition'], index=False)
+        frames[i] = frame
+
+    save_manifest(date_str, entries, config)
+    return frames
+
+
+def excel_to_csv(date_str: str, config: dict, workbooks: List[WorkbookInfo] = None) -> pd.DataFrame:
+    ''' Saves a csv file for all excel files in given directory and returns its data. '''
+
+    # Reusing probed workbooks from verification if available
+    if workbooks is None:
+        workbooks = probe_workbooks(date_str, config)
 
     # Creating dataframe from excel files
+    if config.get('incremental_collation', True):
+        frames = read_partitions(date_str, config, workbooks)
+    else:
+        frames = read_workbooks(workbooks, config.get('parse_workers', 1), config.get('compact_schema', False))
+    return consolidate(frames, date_str, config)
+
+
+def consolidate(frames: List[pd.DataFrame], date_str: str, config: dict) -> pd.DataFrame:
+    ''' Combines parsed workbooks of a day and saves them as consolidated csv and parquet file. '''
+
     dataDir = os.path.join(config['download_dir'], date_str)
-    dataFiles = [os.path.join(dataDir, f) for f in os.listdir(dataDir) if f.endswith('.xlsx')]
-    df = pd.concat([pd.read_excel(fl, skiprows=3, header=1, skipfooter=1, 
-                        index_col=False, engine='openpyxl', dtype=data_types) for fl in dataFiles])
-    df.drop_duplicates(keep="first", inplace=True)
-
-    # Changing datatype for date
-    date_list = ['Reservation Date', 'Arrival Date', 'Departure Date', 'Confirmation Date', 'Reservation Changed on', 'Date']
-    for entry in date_list:
-        df[entry] = pd.to_datetime(df[entry])
-
-    # Creating subset of dataframe by start and end date
-    start_date = datetime.strptime(date_str, '%Y-%m-%d').replace(day=1)
-    num_of_months = config['end_month_offset'] - config['start_month_offset'] + 1
-    end_date = start_date + relativedelta(months=num_of_months)
-    df = df[df['Date'] >= start_date]
-    df = df[df['Date'] < end_date]
-    df['Report Date'] = date_str
-
-    # Saving dataframe as csv file with start date as name
+    with instrumentation.step('consolidate', rows_in=sum(len(frame) for frame in frames)) as record:
+        df = concat_frames(frames)
+
+        # Dropping duplicate rows by a hash of every column, counting them for the run report
+        duplicated = pd.util.hash_pandas_object(df, index=False).duplicated(keep="first").to_numpy()
+        df = df[~duplicated]
+        record['duplicates_dropped'] = int(duplicated.sum())
+        if duplicated.any():
+            logger.info(f"Dropped {duplicated.sum()} duplicate rows of {len(duplicated)}")
+
+        # Changing datatype for date
+        df = parse_date_columns(df)
+
+        # Creating subset of dataframe by start and end date
+        start_date = datetime.strptime(date_str, '%Y-%m-%d').replace(day=1)
+        num_of_months = config['end_month_offset'] - config['start_month_offset'] + 1
+        end_date = start_date + relativedelta(months=num_of_months)
+        df = df[df['Date'] >= start_date]
+        df = df[df['Date'] < end_date]
+        df['Report Date'] = date_str
+        record['rows_out'] = len(df)
+
+    # Saving dataframe as csv and parquet file with start date as name
     filename = os.path.join(dataDir, f"{date_str}_consolidated_data.csv")
-    df.to_csv(filename, index=False)
+    with instrumentation.step('write_consolidated', rows_out=len(df)) as record:
+        out_filename = write_consolidated(df, filename, config.get('output_codec'))
+        record['bytes_written'] = instrumentation.file_size(out_filename, columnar_path(filename))
+
+    # Keeping every day's data in history store for queries over many report dates
+    if config.get('history_store', False):
+        append_report(df, date_str, config)
     
-    return
+    return df
 
 
-def create_summary(field_name: str, output_file_name: str, report_date: str, config: dict) -> None:
-    ''' Creates a csv file based on field name given. '''
+HOTEL_NAMES = {
+    'Evolve Back Kuruba Safari Lodge, Kabini': 'EB Kabini',
+    'Evolve Back Chikkana Halli Estate, Coorg': 'EB Coorg',
+    'Evolve Back Kamalapura Palace, Hampi': 'EB Hampi'
+}
+
 
-    file_path = os.path.join(config['download_dir'], report_date, f"{report_date}_consolidated_data.csv")
-    df = pd.read_csv(file_path)
+def short_hotel_names(hotel_names: pd.Series) -> pd.Series:
+    ''' Returns hotel names as shown in summaries, renaming categories in place of values if categorical. '''
+
+    if isinstance(hotel_names.dtype, pd.CategoricalDtype):
+        renamed = [HOTEL_NAMES.get(name, name) for name in hotel_names.cat.categories]
+        if len(set(renamed)) == len(renamed):
+            return hotel_names.cat.rename_categories(renamed)
+        hotel_names = hotel_names.astype(object)
+    return hotel_names.replace(HOTEL_NAMES)
+
+
+def create_summaries(report_date: str, config: dict, summaries: dict = None, df: pd.DataFrame = None) -> None:
+    ''' Creates a csv file for every summary, aggregating consolidated data only once.
+    Consolidated data is read from disk unless given. '''
+
+    if summaries is None:
+        summaries = configured_summaries(config)
+
+    if df is None:
+        file_path = os.path.join(config['download_dir'], report_date, f"{report_date}_consolidated_data.csv")
+        with instrumentation.step('read_consolidated') as record:
+            df = read_consolidated(file_path, config.get('compact_schema', False))
+            record['rows_out'] = len(df)
 
     df = df[df['Reservation Status'].isin([
         'CONFIRMED', 'CHECKED OUT', 'IN-HOUSE'])]
     df = df[df['Revenue Head'].isin([
         'ROOM CHARGE', 'MEAL - DINNER', 'MEAL - BREAKFAST', 'MEAL - LUNCH', 'HONEYMOON PACKAGE'])]
-    df['Hotel Name'].replace({
-        'Evolve Back Kuruba Safari Lodge, Kabini': 'EB Kabini',
-        'Evolve Back Chikkana Halli Estate, Coorg': 'EB Coorg',
-        'Evolve Back Kamalapura Palace, Hampi': 'EB Hampi'
-    }, inplace=True)
-    df['Month Year'] = pd.to_datetime(df['Date']).dt.to_period('M')
+    df = df.assign(**{'Hotel Name': short_hotel_names(df['Hotel Name']),
+                      'Month Year': df['Date'].dt.to_period('M')})
+
+    # Aggregating once by all summary fields, keeping missing values so every summary can roll up from it.
+    # Categoricals are grouped by their codes since groupby drops their missing values even with dropna=False.
+    fields = list(dict.fromkeys(summaries.values()))
+    codes = {field: df[field].cat.codes for field in fields
+             if field != 'Hotel Name' and isinstance(df[field].dtype, pd.CategoricalDtype)}
+    cube = (df.assign(**codes).groupby(['Hotel Name', 'Month Year'] + fields, dropna=False, observed=True)
+              .agg(Amount=("Amount Payable", 'sum')).reset_index())
+    for field in codes:
+        cube[field] = pd.Categorical.from_codes(cube[field], df[field].cat.categories)
 
-    df = (df.groupby(['Hotel Name', field_name, 'Month Year'])
-            .agg(Amount=("Amount Payable", 'sum')).reset_index().round(2))
-    df['Report Date'] = report_date
+    for output_file_name, field_name in summaries.items():
+        with instrumentation.step('summary', file=output_file_name, rows_in=len(cube)) as record:
+            summary = (cube.groupby(['Hotel Name', field_name, 'Month Year'], observed=True)
+                           .agg(Amount=("Amount", 'sum')).reset_index().round(2))
+            summary['Report Date'] = report_date
 
-    # Saving as csv
-    out_filename = os.path.join(config['download_dir'], report_date, f'{report_date}_{output_file_name}')
-    df.to_csv(out_filename, index=False)
+            # Saving as csv
+            out_filename = os.path.join(config['download_dir'], report_date, f'{report_date}_{output_file_name}')
+            out_filename = write_csv(summary, out_filename, config.get('output_codec'))
+            record['rows_out'] = len(summary)
+            record['bytes_written'] = instrumentation.file_size(out_filename)
+        logger.info(f"Created {report_date}_{output_file_name} successfully!")
 
 
-def main(date_str: str):
-    # Reading config file
-    with open('config.json') as f:
-        config = json.load(f)
+def create_summary(field_name: str, output_file_name: str, report_date: str, config: dict) -> None:
+    ''' Creates a csv file based on field name given. '''
+
+    create_summaries(report_date, config, {output_file_name: field_name})
+
+
+def output_files(date_str: str, config: dict) -> List[str]:
+    ''' Returns paths of consolidated data and summary files written for given date. '''
+
+    data_dir = os.path.join(config['download_dir'], date_str)
+    consolidated_file = os.path.join(data_dir, f"{date_str}_consolidated_data.csv")
+    return [find_output(consolidated_file), columnar_path(consolidated_file)] + [
+        find_output(os.path.join(data_dir, f'{date_str}_{output_file_name}'))
+        for output_file_name in configured_summaries(config)]
+
+
+def main(date_str: str, workbooks: List[WorkbookInfo] = None, context: PipelineContext = None):
+    # Reading config file unless a run already did
+    if context is None:
+        context = PipelineContext(date_str)
 
     # To convert all excel files to one csv file
-    excel_to_csv(date_str, config)
+    context.consolidated = excel_to_csv(date_str, context.config, workbooks or context.workbooks)
     logger.info(f"Created {date_str}_consolidated_data.csv successfully!")
 
-    # To create department summary
-    create_summary('Market Segment', 'department_summary.csv', date_str, config)
-    logger.info(f"Created {date_str}_department_summary.csv successfully!")
-
-    # To create excutive summary
-    create_summary('Business Source', 'executive_summary.csv', date_str, config)
-    logger.info(f"Created {date_str}_executive_summary.csv successfully!")
+    # To create department, executive and any other configured summaries
+    create_summaries(date_str, context.config, df=context.consolidated)
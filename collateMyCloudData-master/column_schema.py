@@ -0,0 +1,120 @@
+''' Types and date formats of every column of the Guest Transaction History report. '''
+
+import logging
+from typing import List, NamedTuple
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Excel date cells are read as text like '2021-05-01 00:00:00', pandas writes csv dates as '2021-05-01'
+# when no value of the column has a time. Formats are tried in this order.
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S.%f')
+
+
+class Column(NamedTuple):
+    name: str
+    dtype: type
+    category: bool = False
+    date_formats: tuple = ()
+
+
+COLUMNS = [
+    Column('Hotel Name', str, category=True), Column('External Refrence #', str),
+    Column('Confirmation No', int), Column('Account Id', int), Column('Invoice/Bill No.', str),
+    Column('Guest Name', str), Column('Reservation Date', str, date_formats=DATE_FORMATS),
+    Column('Created By', str, category=True), Column('Arrival Date', str, date_formats=DATE_FORMATS),
+    Column('Departure Date', str, date_formats=DATE_FORMATS), Column('Room Type', str, category=True),
+    Column('Room no', str), Column('Adult Pax', int), Column('Youth Pax', int), Column('Child Pax', int),
+    Column('Total Pax', int), Column('Reservation Status', str, category=True),
+    Column('Confirmation Date', str, date_formats=DATE_FORMATS),
+    Column('Reservation Changed on', str, date_formats=DATE_FORMATS), Column('Guest Email', str),
+    Column('Guest Contact No', str), Column('Guest City', str, category=True),
+    Column('Guest State', str, category=True), Column('Guest Country', str, category=True),
+    Column('Nationality', str, category=True), Column('Rate Type', str, category=True),
+    Column('Booked Thru/Channel', str, category=True), Column('Business Source', str, category=True),
+    Column('Market Segment', str, category=True), Column('Guest Class', str, category=True),
+    Column('System Rate', float), Column('Agreed Rate', float), Column('Date', str, date_formats=DATE_FORMATS),
+    Column('Revenue Head', str, category=True), Column('Amount', float), Column('Discount', float),
+    Column('Taxable', float), Column('Taxes', float), Column('Amount Payable', float),
+]
+
+# Datatypes used while reading, date columns are read as text and parsed afterwards
+DATA_TYPES = {column.name: column.dtype for column in COLUMNS}
+DATE_COLUMNS = [column.name for column in COLUMNS if column.date_formats]
+CATEGORY_COLUMNS = [column.name for column in COLUMNS if column.category]
+INTEGER_COLUMNS = [column.name for column in COLUMNS if column.dtype is int]
+AMOUNT_COLUMNS = ['Amount', 'Discount', 'Taxable', 'Taxes', 'Amount Payable']
+DATE_FORMATS_BY_COLUMN = {column.name: column.date_formats for column in COLUMNS if column.date_formats}
+
+
+def parse_dates(values: pd.Series, formats: tuple = DATE_FORMATS) -> pd.Series:
+    ''' Parses a text column with explicit formats, once for every distinct value. '''
+
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return values
+
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Index(uniques).astype(str)
+    parsed = np.full(len(uniques), np.datetime64('NaT'), dtype='datetime64[ns]')
+    missing = np.ones(len(uniques), dtype=bool)
+    for date_format in formats:
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(uniques[missing], format=date_format, errors='coerce').values
+        missing = np.isnat(parsed)
+
+    # Values in none of the formats are left to pandas to infer, as before the schema existed
+    if missing.any():
+        logger.warning(f"{values.name}: {missing.sum()} values not in {formats}, e.g. {uniques[missing][0]}")
+        parsed[missing] = pd.to_datetime(uniques[missing]).values
+
+    result = np.full(len(codes), np.datetime64('NaT'), dtype='datetime64[ns]')
+    result[codes >= 0] = parsed[codes[codes >= 0]]
+    return pd.Series(result, index=values.index, name=values.name)
+
+
+def parse_date_columns(df: pd.DataFrame) -> pd.DataFrame:
+    ''' Returns dataframe with all date columns typed, parsing only those that are not typed yet. '''
+
+    untyped = [column for column in DATE_COLUMNS
+               if column in df and not pd.api.types.is_datetime64_any_dtype(df[column].dtype)]
+    if not untyped:
+        return df
+    return df.assign(**{column: parse_dates(df[column], DATE_FORMATS_BY_COLUMN[column]) for column in untyped})
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    ''' Converts low cardinality columns to categoricals, downcasts integers and types dates. '''
+
+    for column in CATEGORY_COLUMNS:
+        if column in df and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    # Amounts stay float64, float32 would lose paise on large totals
+    for column in INTEGER_COLUMNS:
+        if column in df:
+            df[column] = pd.to_numeric(df[column], downcast='integer')
+    return parse_date_columns(df)
+
+
+def concat_frames(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    ''' Concatenates frames, unifying categories first so categorical columns stay categorical. '''
+
+    for column in CATEGORY_COLUMNS:
+        present = [frame[column] for frame in frames if column in frame]
+        if present and all(isinstance(values.dtype, pd.CategoricalDtype) for values in present):
+            categories = union_categoricals(present).categories
+            frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) if column in frame else frame
+                      for frame in frames]
+    return pd.concat(frames)
+
+
+def read_csv(path, compact: bool = False) -> pd.DataFrame:
+    ''' Reads a csv file, or an open file, written by the pipeline with the schema's types. '''
+
+    df = pd.read_csv(path, dtype={name: dtype for (name, dtype) in DATA_TYPES.items() if name not in DATE_COLUMNS})
+    df = parse_date_columns(df)
+    return compact_frame(df) if compact else df
@@ -0,0 +1,37 @@
+import logging
+import os
+
+import pandas as pd
+
+import column_schema
+from output_codec import find_output, open_output, write_csv
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def columnar_path(csv_path: str) -> str:
+    ''' Returns path of the parquet file kept next to given csv file. '''
+
+    return os.path.splitext(csv_path)[0] + '.parquet'
+
+
+def write_consolidated(df: pd.DataFrame, csv_path: str, codec: str = None) -> str:
+    ''' Saves dataframe as csv file along with a typed parquet copy, returns path of the csv file written. '''
+
+    out_path = write_csv(df, csv_path, codec)
+    df.to_parquet(columnar_path(csv_path), index=False, compression=codec or 'snappy')
+    return out_path
+
+
+def read_consolidated(csv_path: str, compact: bool = False) -> pd.DataFrame:
+    ''' Loads consolidated data from parquet file, falling back to csv file if it is missing. '''
+
+    parquet_path = columnar_path(csv_path)
+    if os.path.exists(parquet_path):
+        df = pd.read_parquet(parquet_path)
+        return column_schema.compact_frame(df) if compact else df
+
+    csv_path = find_output(csv_path)
+    logger.info(f"{parquet_path} not found, reading {csv_path}")
+    with open_output(csv_path) as f:
+        return column_schema.read_csv(f, compact)
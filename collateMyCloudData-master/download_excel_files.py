@@ -1,79 +1,294 @@
+import argparse
 import json
 import logging
 import os
 import time
+from collections import deque
 from datetime import datetime
-from threading import Thread
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Thread
+from typing import Callable, List, NamedTuple, Optional
 
 from dateutil.relativedelta import relativedelta
 from selenium import webdriver
 from selenium.webdriver.common.by import By
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from selenium.webdriver.support import expected_conditions as ec
 from selenium.webdriver.support.ui import WebDriverWait
 
+import instrumentation
+from mycloud_capture import BASE_URL, save_capture, steps_from_log
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
-class MyCloudWorker(Thread):
+# Suffixes used by browsers for files still being written
+PARTIAL_SUFFIXES = ('.crdownload', '.part', '.tmp')
+REPORT_FILE_NAME = "Guest_Transaction_History.xlsx"
+
+
+def clear_download_dir(download_dir: str):
+    ''' Removes leftovers of earlier downloads so they are not mistaken for the next report. '''
+
+    with os.scandir(download_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                os.remove(entry.path)
+
+
+def wait_for_download(download_dir: str, file_name: str, timeout: float = 300, poll_interval: float = 0.5) -> float:
+    ''' Waits till file is completely written to download dir and returns seconds it took to land. '''
+
+    start = time.perf_counter()
+    path = os.path.join(download_dir, file_name)
+    last_size = None
+    while time.perf_counter() - start < timeout:
+        with os.scandir(download_dir) as entries:
+            names = [entry.name for entry in entries]
+
+        # File is complete once browser has no partial file left and its size stops changing
+        if file_name in names and not any(name.endswith(PARTIAL_SUFFIXES) for name in names):
+            size = os.path.getsize(path)
+            if size > 0 and size == last_size:
+                return time.perf_counter() - start
+            last_size = size
+        else:
+            last_size = None
+        time.sleep(poll_interval)
+
+    raise TimeoutError(f"{file_name} not downloaded to {download_dir} in {timeout} seconds")
+
+
+class DownloadTask(NamedTuple):
+    ''' Report of one month of a property. '''
+    property_name: str
+    property_id: str
+    start_date: str
+    end_date: str
+    attempt: int = 0
+
+
+class TaskQueue:
+    ''' Thread safe queue of download tasks shared by all browser sessions. '''
+
+    def __init__(self, tasks: List[DownloadTask], max_attempts: int = 3, backoff: float = 30):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.condition = Condition()
+        self.pending = {}
+        for task in tasks:
+            self.pending.setdefault(task.property_name, deque()).append(task)
+        self.delayed = []
+        self.in_flight = 0
+        self.failed = []
+        self.sequence = count()
+
+    def get(self, preferred: str = None) -> Optional[DownloadTask]:
+        ''' Returns next task, preferring given property. Returns None once all tasks are finished. '''
+
+        with self.condition:
+            while True:
+                # Moving tasks whose backoff is over back to pending
+                while self.delayed and self.delayed[0][0] <= time.monotonic():
+                    task = heappop(self.delayed)[2]
+                    self.pending[task.property_name].appendleft(task)
+
+                task = self._pop(preferred)
+                if task is not None:
+                    self.in_flight += 1
+                    return task
+                if not self.delayed and self.in_flight == 0:
+                    return None
+                self.condition.wait(self.delayed[0][0] - time.monotonic() if self.delayed else None)
+
+    def _pop(self, preferred: str) -> Optional[DownloadTask]:
+        # Staying on the property a session is logged in to, else taking over the property with most work left
+        if self.pending.get(preferred):
+            return self.pending[preferred].popleft()
+        remaining = [(len(tasks), name) for (name, tasks) in self.pending.items() if tasks]
+        if not remaining:
+            return None
+        return self.pending[max(remaining)[1]].popleft()
+
+    def done(self, task: DownloadTask):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def retry(self, task: DownloadTask):
+        ''' Puts a failed task back after an exponential backoff, or gives up after max_attempts. '''
+
+        with self.condition:
+            self.in_flight -= 1
+            if task.attempt + 1 >= self.max_attempts:
+                self.failed.append(task)
+                logger.error("Giving up on %s from %s to %s after %s tries" % (
+                    task.property_name, task.start_date, task.end_date, task.attempt + 1))
+            else:
+                ready_at = time.monotonic() + self.backoff * 2 ** task.attempt
+                heappush(self.delayed, (ready_at, next(self.sequence), task._replace(attempt=task.attempt + 1)))
+            self.condition.notify_all()
+
+    def unfinished(self) -> List[DownloadTask]:
+        ''' Returns tasks still waiting to be downloaded or retried. '''
+
+        with self.condition:
+            return [task for tasks in self.pending.values() for task in tasks] + [task for (_, _, task) in self.delayed]
+
+    def leave(self):
+        ''' Called when a session exits, waking the other sessions to check again whether work is left. '''
+
+        with self.condition:
+            self.condition.notify_all()
+
+
+def store_report(data: dict, date_str: str, task: DownloadTask, downloaded_file: str) -> str:
+    ''' Moves a downloaded report to the date folder as {property}_{YYYY-MM}.xlsx and returns its new path. '''
+
+    path_name = os.path.join(data["download_dir"], date_str)
+    new_filename = task.property_name + "_" + datetime.strptime(task.start_date, '%d/%m/%Y').strftime("%Y-%m") + ".xlsx"
+    if not os.path.exists(path_name):
+        os.makedirs(path_name)
+    os.rename(downloaded_file, os.path.join(path_name, new_filename))
+    return os.path.join(path_name, new_filename)
+
+
+class ReportWorker(Thread):
+    ''' Session downloading reports of the task queue till no task is left, staying on the property it is logged
+    in to. Subclasses open the session, log in to a property and fetch a report over their own kind of session. '''
+
     logger = logging.getLogger(__name__)
 
-    def __init__(self, data, property_name, property_id, date_list):
+    def __init__(self, data, task_queue: TaskQueue, session_name: str, date_str: str,
+                 on_downloaded: Callable[[str], None] = None):
         Thread.__init__(self)
         self.data = data
-        self.property_name = property_name
-        self.property_id = property_id
-        self.date_list = date_list
+        self.task_queue = task_queue
+        self.session_name = session_name
+        self.date_str = date_str
+        self.on_downloaded = on_downloaded
+
+    def open_session(self, download_dir: str):
+        raise NotImplementedError
+
+    def close_session(self, session):
+        pass
+
+    def login(self, session, task: DownloadTask):
+        ''' Sets session up to export reports of the task's property. '''
+        raise NotImplementedError
+
+    def logout(self, session, property_name: str):
+        pass
+
+    def fetch(self, session, task: DownloadTask, downloaded_file: str, record: dict):
+        ''' Exports report of a task to downloaded_file, adding timings to the task's record. '''
+        raise NotImplementedError
 
     def run(self):
         start = time.perf_counter()
+        download_dir = os.path.join(self.data["download_dir"], "tmp", self.session_name)
+        if not os.path.exists(download_dir):
+            os.makedirs(download_dir)
+        session = None
+        current_property = None
+        try:
+            # Opened in here, so a session that cannot start still leaves the queue
+            try:
+                session = self.open_session(download_dir)
+            except Exception:
+                self.logger.exception("Could not start session %s" % self.session_name)
+                return
+            self.logger.info("Started session %s" % self.session_name)
+            while True:
+                task = self.task_queue.get(current_property)
+                if task is None:
+                    break
+
+                start_download = time.perf_counter()
+                downloaded = False
+                try:
+                    with instrumentation.step('download_report', property=task.property_name,
+                                              month=task.start_date, attempt=task.attempt) as record:
+                        try:
+                            # Logging in to the task's property if session is on another one
+                            if task.property_name != current_property:
+                                if current_property is not None:
+                                    self.logout(session, current_property)
+                                current_property = None
+                                self.login(session, task)
+                                current_property = task.property_name
+
+                            clear_download_dir(download_dir)
+                            downloaded_file = os.path.join(download_dir, REPORT_FILE_NAME)
+                            self.fetch(session, task, downloaded_file, record)
+                            record['bytes_written'] = instrumentation.file_size(downloaded_file)
+
+                            # To move file to date name folder
+                            stored_file = store_report(self.data, self.date_str, task, downloaded_file)
+                            if self.on_downloaded is not None:
+                                self.on_downloaded(stored_file)
+                            downloaded = True
+                        except Exception:
+                            self.logger.exception("Could not download %s for %s to %s. Tries: %s" % (
+                                task.property_name, task.start_date, task.end_date, task.attempt))
+                            # Session state is unknown after a failure, so logging in again for next task
+                            current_property = None
+                            record['failed'] = True
+                finally:
+                    # Released even if the session dies, so other sessions do not wait for this task forever
+                    if downloaded:
+                        self.task_queue.done(task)
+                    else:
+                        self.task_queue.retry(task)
+                if not downloaded:
+                    continue
+
+                self.logger.info('Completed %s from %s to %s in session %s time taken %s seconds' % (
+                    task.property_name, task.start_date, task.end_date, self.session_name,
+                    round((time.perf_counter() - start_download), 2)))
+
+            if current_property is not None:
+                self.logout(session, current_property)
+        finally:
+            self.task_queue.leave()
+            if session is not None:
+                self.close_session(session)
+            self.logger.info(f"Closing {self.session_name}. The whole process took {round(time.perf_counter() - start, 2)} seconds")
+
+
+class MyCloudWorker(ReportWorker):
+    ''' Downloads reports through a headless Chrome session. '''
+
+    def open_session(self, download_dir: str) -> webdriver:
         options = webdriver.ChromeOptions()
         options.headless = True
         options.add_argument('log-level=3')
-        download_dir = os.path.join(self.data["download_dir"], "tmp", self.property_name)
-        if not os.path.exists(download_dir):
-            os.makedirs(download_dir)
-        
         prefs = {"download.default_directory": download_dir}
         options.add_experimental_option("prefs", prefs)
         driver = webdriver.Chrome(executable_path=self.data["chrome_driver_path"], options=options)
         driver.maximize_window()
+        return driver
 
-        self.logger.info("Started working on %s" % self.property_name)
-        try:
-            self.setup(driver, self.data["username"], self.data["password"], self.property_id)
-        
-            for (start_date, end_date) in self.date_list:
-                start_download = time.perf_counter()
-                
-                # Trying 3 times to download
-                for x in range(3):
-                    self.download_report(driver, start_date, end_date)
-                    downloaded_file = os.path.join(download_dir, "Guest_Transaction_History.xlsx")
-                    
-                    # Moving and renaming downloaded file
-                    if os.path.exists(downloaded_file):
-                        # To move file to date name folder
-                        path_name = os.path.join(self.data["download_dir"], datetime.today().strftime("%Y-%m-%d"))
-                        new_filename = self.property_name + "_" + datetime.strptime(start_date, '%d/%m/%Y').strftime("%Y-%m") + ".xlsx"
-                        
-                        if not os.path.exists(path_name):
-                            os.makedirs(path_name)
-                        # Move to file to new dir and break out of loop
-                        os.rename(downloaded_file, os.path.join(path_name, new_filename))
-                        break
-                    else:
-                        logger.info("Could not download %s for %s to %s. Tries: %s" % (
-                            self.property_name, start_date, end_date, x))
+    def close_session(self, driver: webdriver):
+        driver.close()
 
-                self.logger.info('Completed from %s to %s for %s time taken %s seconds' % (
-                    self.property_name, start_date, end_date, round((time.perf_counter() - start_download), 2)))
-            
-            driver.execute_script('doLogout();')
-            self.logger.info("Logging out of %s" % self.property_name)
-        finally:
-            driver.close()
-            self.logger.info(f"Closing Driver for {self.property_name}. The whole process took {round(time.perf_counter() - start, 2)} seconds")
+    def login(self, driver: webdriver, task: DownloadTask):
+        self.setup(driver, self.data["username"], self.data["password"], task.property_id)
+
+    def fetch(self, driver: webdriver, task: DownloadTask, downloaded_file: str, record: dict):
+        self.download_report(driver, task.start_date, task.end_date)
+        landed = wait_for_download(os.path.dirname(downloaded_file), os.path.basename(downloaded_file),
+                                   self.data.get("download_timeout", 300))
+        self.logger.info('Report of %s from %s landed %s seconds after export' % (
+            task.property_name, task.start_date, round(landed, 2)))
+        record['landed_s'] = round(landed, 4)
+
+    def logout(self, driver: webdriver, property_name: str):
+        driver.execute_script('doLogout();')
+        self.logger.info("Logging out of %s" % property_name)
 
     @staticmethod
     def setup(driver: webdriver, username: str, password: str, prop_id: str):
@@ -135,8 +350,6 @@ class MyCloudWorker(Thread):
         wait.until(ec.invisibility_of_element((By.ID, "overlayProcess")))
         # Wait for invisibility of Overlay Process (Not sure why it is being done twice but it works)
         wait.until(ec.invisibility_of_element((By.ID, "overlayProcess")))
-        # End of Loop
-        time.sleep(2)
         # Wait till From Date Textbox is clickable
         wait.until(ec.element_to_be_clickable((By.ID, "cmbDatefrom")))
         return
@@ -155,19 +368,100 @@ def get_date_strings(start_date: datetime, start_month: int, end_month: int) ->
     return list(rv)
 
 
-def main(date_str: str):
-    # Reading download config file
-    with open('config.json') as f:
-        data = json.load(f)
+def main(date_str: str, on_downloaded: Callable[[str], None] = None, data: dict = None) -> List[DownloadTask]:
+    # Reading download config file unless a run already did
+    if data is None:
+        with open('config.json') as f:
+            data = json.load(f)
     
     start_date = datetime.strptime(date_str, '%Y-%m-%d')
     date_list = get_date_strings(start_date, data["start_month_offset"], data["end_month_offset"])
+
+    # One task per property and month, pulled by a bounded number of browser sessions
+    tasks = [DownloadTask(key, value, start, end)
+             for (key, value) in data["properties"].items()
+             for (start, end) in date_list]
+    task_queue = TaskQueue(tasks, data.get("download_attempts", 3), data.get("retry_backoff", 30))
+    if data.get("fetcher", "browser") == "http":
+        if not data.get("http_capture"):
+            raise ValueError('"fetcher": "http" replays a capture of the browser flow, record one with '
+                             '"python download_excel_files.py capture" and set "http_capture" in config')
+        # Http sessions are cheap, so months of a property are fetched by several of them at once
+        from http_fetcher import HttpReportWorker as worker_class
+        num_sessions = min(data.get("http_sessions", 8), len(tasks))
+    else:
+        worker_class = MyCloudWorker
+        num_sessions = min(data.get("max_sessions", len(data["properties"])), len(tasks))
+
     workers = []
-    
-    for (key, value) in data["properties"].items():
-        worker = MyCloudWorker(data, key, value, date_list)
+    for x in range(num_sessions):
+        worker = worker_class(data, task_queue, f"session_{x}", date_str, on_downloaded)
         worker.start()
         workers.append(worker)
     
     for worker in workers:
         worker.join()
+
+    # Tasks no session got to count as failed too, e.g. when no browser could be started
+    failed = task_queue.failed + task_queue.unfinished()
+    if failed:
+        logger.error("Could not download %s reports" % len(failed))
+    return failed
+
+
+def capture_requests(data: dict, capture_file: str, date_str: str) -> dict:
+    ''' Records the requests of a browser session logging in to every property and exporting the report of the
+    month of date_str once, and saves them for the http fetcher to replay. '''
+
+    options = webdriver.ChromeOptions()
+    options.headless = True
+    options.add_argument('log-level=3')
+    download_dir = os.path.join(data["download_dir"], "tmp", "capture")
+    os.makedirs(download_dir, exist_ok=True)
+    options.add_experimental_option("prefs", {"download.default_directory": download_dir})
+    capabilities = DesiredCapabilities.CHROME.copy()
+    capabilities['goog:loggingPrefs'] = {'performance': 'ALL'}
+    driver = webdriver.Chrome(executable_path=data["chrome_driver_path"], options=options,
+                              desired_capabilities=capabilities)
+
+    def post_data(request_id: str) -> str:
+        return driver.execute_cdp_cmd('Network.getRequestPostData', {'requestId': request_id})['postData']
+
+    (start_date, end_date) = get_date_strings(datetime.strptime(date_str, '%Y-%m-%d'), 0, 0)[0]
+    values = {'username': data["username"], 'password': data["password"],
+              'start_date': start_date, 'end_date': end_date}
+    capture = {'base_url': BASE_URL, 'setup': {}, 'export': []}
+    try:
+        for (property_name, prop_id) in data["properties"].items():
+            MyCloudWorker.setup(driver, data["username"], data["password"], prop_id)
+            capture['setup'][property_name] = steps_from_log(driver.get_log('performance'), BASE_URL, values, post_data)
+            logger.info("Recorded %s requests of setting up %s" % (len(capture['setup'][property_name]), property_name))
+            if not capture['export']:
+                clear_download_dir(download_dir)
+                MyCloudWorker.download_report(driver, start_date, end_date)
+                wait_for_download(download_dir, REPORT_FILE_NAME, data.get("download_timeout", 300))
+                capture['export'] = steps_from_log(driver.get_log('performance'), BASE_URL, values, post_data)
+                logger.info("Recorded %s requests of exporting a report" % len(capture['export']))
+            driver.execute_script('doLogout();')
+            # Requests of the logout are not part of either flow
+            driver.get_log('performance')
+    finally:
+        driver.quit()
+
+    save_capture(capture, capture_file)
+    logger.info(f"Saved capture of the browser flow to {capture_file}")
+    return capture
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Records the browser flow for the http fetcher.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    capture_parser = subparsers.add_parser('capture', help='record requests of logging in and exporting a report')
+    capture_parser.add_argument('output', help='capture file to write, set as http_capture in config')
+    capture_parser.add_argument('--date', default=datetime.today().strftime('%Y-%m-%d'),
+                                help='report date whose first month is exported, YYYY-MM-DD')
+    args = parser.parse_args()
+
+    with open('config.json') as f:
+        config = json.load(f)
+    capture_requests(config, args.output, args.date)
@@ -0,0 +1,221 @@
+''' History of consolidated data, partitioned by report date and stay month. A report date is only written
+again when a rerun of the day changed its consolidated data.
+
+Layout under {download_dir}/history:
+    report_date=YYYY-MM-DD/stay_month=YYYY-MM.parquet   rows of the report date staying in that month
+    report_date=YYYY-MM-DD/index.parquet                reservation key and stay month of every reservation
+    report_date=YYYY-MM-DD/source.json                  fingerprint of the consolidated data it was stored from
+'''
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+from datetime import datetime
+from typing import List
+
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+import instrumentation
+from column_schema import concat_frames, parse_date_columns
+from columnar_cache import read_consolidated
+from process_delta import (CONF_KEY_COLUMNS, available_dates, compute_delta, consolidated_file, modified_time,
+                           row_fingerprint)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+HISTORY_DIR = 'history'
+INDEX_FILE = 'index.parquet'
+# Fingerprint of the consolidated data a report date was stored from
+SOURCE_FILE = 'source.json'
+
+
+def history_dir(config: dict) -> str:
+    return os.path.join(config['download_dir'], HISTORY_DIR)
+
+
+def report_dir(date_str: str, config: dict) -> str:
+    return os.path.join(history_dir(config), f"report_date={date_str}")
+
+
+def stay_month_path(date_str: str, stay_month: str, config: dict) -> str:
+    return os.path.join(report_dir(date_str, config), f"stay_month={stay_month}.parquet")
+
+
+def reservation_key(df: pd.DataFrame) -> pd.Series:
+    ''' Returns hash of Hotel Name and Account Id of every row, same for csv, parquet and compact data. '''
+
+    keys = pd.DataFrame({'Hotel Name': df['Hotel Name'].astype(str), 'Account Id': df['Account Id'].astype('int64')},
+                        columns=CONF_KEY_COLUMNS)
+    return pd.Series(row_fingerprint(keys, CONF_KEY_COLUMNS), index=df.index)
+
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    ''' Returns sha256 of all rows of a dataframe, same for csv, parquet and compact data. '''
+
+    columns = sorted(df.columns)
+    digest = hashlib.sha256(json.dumps(columns).encode())
+    digest.update(row_fingerprint(df, columns).tobytes())
+    return digest.hexdigest()
+
+
+def stored_fingerprint(date_str: str, config: dict):
+    ''' Returns fingerprint of the data a report date was stored from, None if it is not stored. '''
+
+    path = os.path.join(report_dir(date_str, config), SOURCE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)['sha256']
+
+
+def stored_modified_time(date_str: str, config: dict) -> float:
+    path = os.path.join(report_dir(date_str, config), SOURCE_FILE)
+    return os.path.getmtime(path) if os.path.exists(path) else 0
+
+
+def report_dates(config: dict, start: str = None, end: str = None) -> List[str]:
+    ''' Returns report dates in history store from start to end, oldest first. '''
+
+    if not os.path.exists(history_dir(config)):
+        return []
+    dates = [m.group(1) for m in (re.fullmatch(r'report_date=(\d{4}-\d{2}-\d{2})', d)
+                                  for d in os.listdir(history_dir(config))) if m]
+    return sorted(d for d in dates if (start is None or d >= start) and (end is None or d <= end))
+
+
+def append_report(df: pd.DataFrame, date_str: str, config: dict) -> bool:
+    ''' Adds consolidated data of a report date to history store, replacing what was stored for it if the data
+    changed since, e.g. on a rerun of the day. Returns False if the same data is already there. '''
+
+    df = parse_date_columns(df)
+    fingerprint = frame_fingerprint(df)
+    stored = stored_fingerprint(date_str, config)
+    if stored == fingerprint:
+        logger.info(f"History of {date_str} already stored, leaving it unchanged")
+        return False
+    stay_months = df['Date'].dt.strftime('%Y-%m')
+
+    # Writing into a temporary dir first, so that readers never see a partly written report date
+    out_dir = report_dir(date_str, config)
+    tmp_dir = out_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    with instrumentation.step('append_history', rows_in=len(df)) as record:
+        for stay_month, part in df.groupby(stay_months, sort=True):
+            part.to_parquet(os.path.join(tmp_dir, f"stay_month={stay_month}.parquet"), index=False)
+        index = pd.DataFrame({'key': reservation_key(df).to_numpy(), 'stay_month': stay_months.to_numpy()})
+        index.drop_duplicates().to_parquet(os.path.join(tmp_dir, INDEX_FILE), index=False)
+        with open(os.path.join(tmp_dir, SOURCE_FILE), 'w') as f:
+            json.dump({'sha256': fingerprint}, f)
+
+        # Swapping the new report date in, the old one is only removed once it is out of the way
+        if os.path.exists(out_dir):
+            old_dir = out_dir + '.old'
+            shutil.rmtree(old_dir, ignore_errors=True)
+            os.rename(out_dir, old_dir)
+            os.rename(tmp_dir, out_dir)
+            shutil.rmtree(old_dir)
+        else:
+            os.rename(tmp_dir, out_dir)
+        record['partitions'] = stay_months.nunique()
+    logger.info(f"{'Replaced' if stored else 'Stored'} history of {date_str} in {stay_months.nunique()} "
+                f"stay month partitions")
+    return True
+
+
+def read_report(date_str: str, config: dict, stay_months: List[str] = None) -> pd.DataFrame:
+    ''' Loads rows of a report date from history store, only from given stay months if any. '''
+
+    if not os.path.exists(report_dir(date_str, config)):
+        raise FileNotFoundError(f"No history stored for {date_str}")
+    files = sorted(f for f in os.listdir(report_dir(date_str, config)) if f.startswith('stay_month='))
+    if stay_months is not None:
+        files = [f for f in files if f[len('stay_month='):-len('.parquet')] in stay_months]
+    return concat_frames([pd.read_parquet(os.path.join(report_dir(date_str, config), f)) for f in files])
+
+
+def delta_between(from_date: str, to_date: str, config: dict) -> pd.DataFrame:
+    ''' Returns confirmations, cancellations and modifications of to_date over any earlier from_date. '''
+
+    # Only stay months inside the delta's window are read
+    start_date = datetime.strptime(to_date, '%Y-%m-%d').replace(day=1)
+    num_of_months = config['end_month_offset'] - config['start_month_offset'] + 1
+    stay_months = [(start_date + relativedelta(months=x)).strftime('%Y-%m') for x in range(num_of_months)]
+    with instrumentation.step('delta_between') as record:
+        df_to = read_report(to_date, config, stay_months)
+        df_from = read_report(from_date, config, stay_months)
+        main_df = compute_delta(df_to, df_from, to_date, config)
+        record['rows_in'] = len(df_to) + len(df_from)
+        record['rows_out'] = len(main_df)
+    return main_df
+
+
+def reservation_history(hotel_name: str, account_id: int, config: dict,
+                        start: str = None, end: str = None) -> pd.DataFrame:
+    ''' Returns every stored row of a reservation from start to end report date, oldest first. '''
+
+    key = reservation_key(pd.DataFrame({'Hotel Name': [hotel_name], 'Account Id': [account_id]})).iloc[0]
+    frames = []
+    with instrumentation.step('reservation_history') as record:
+        for date_str in report_dates(config, start, end):
+            index = pd.read_parquet(os.path.join(report_dir(date_str, config), INDEX_FILE))
+            for stay_month in index.loc[index['key'] == key, 'stay_month']:
+                part = pd.read_parquet(stay_month_path(date_str, stay_month, config),
+                                       filters=[('Account Id', '==', int(account_id))])
+                frames.append(part[part['Hotel Name'].astype(str) == hotel_name])
+        record['partitions'] = len(frames)
+    if not frames:
+        return pd.DataFrame(columns=CONF_KEY_COLUMNS)
+    df = concat_frames(frames)
+    return df.sort_values(['Report Date', 'Date'], kind='stable').reset_index(drop=True)
+
+
+def main(start: str = None, end: str = None):
+    ''' Adds consolidated data of all days in download data dir to history store. '''
+
+    with open('config.json') as f:
+        config = json.load(f)
+
+    data_dir = config['download_dir']
+    # Only days stored before their consolidated data was last written are read to compare fingerprints
+    added = [date_str for date_str in available_dates(data_dir, start, end)
+             if stored_modified_time(date_str, config) < modified_time(consolidated_file(data_dir, date_str))
+             and append_report(read_consolidated(consolidated_file(data_dir, date_str)), date_str, config)]
+    logger.info(f"Added or replaced {len(added)} report dates in history store")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Adds to and queries the history store of consolidated data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help='store consolidated data of report dates not stored yet or changed')
+    add_parser.add_argument('--start', help='first report date, YYYY-MM-DD')
+    add_parser.add_argument('--end', help='last report date, YYYY-MM-DD')
+    delta_parser = subparsers.add_parser('delta', help='delta between any two stored report dates')
+    delta_parser.add_argument('from_date')
+    delta_parser.add_argument('to_date')
+    delta_parser.add_argument('--output', help='csv file to write, default is stdout')
+    history_parser = subparsers.add_parser('history', help='rows of one reservation over stored report dates')
+    history_parser.add_argument('hotel_name')
+    history_parser.add_argument('account_id', type=int)
+    history_parser.add_argument('--start', help='first report date, YYYY-MM-DD')
+    history_parser.add_argument('--end', help='last report date, YYYY-MM-DD')
+    history_parser.add_argument('--output', help='csv file to write, default is stdout')
+    args = parser.parse_args()
+
+    if args.command == 'add':
+        main(args.start, args.end)
+    else:
+        with open('config.json') as f:
+            config = json.load(f)
+        if args.command == 'delta':
+            result = delta_between(args.from_date, args.to_date, config)
+        else:
+            result = reservation_history(args.hotel_name, args.account_id, config, args.start, args.end)
+        result.to_csv(args.output if args.output else sys.stdout, index=False)
@@ -0,0 +1,163 @@
+''' Downloads Guest Transaction History reports by replaying the requests of the browser flow over http,
+in place of driving a browser. Selected with "fetcher": "http" in config, along with "http_capture", a capture of
+the browser flow recorded with `python download_excel_files.py capture` (see mycloud_capture.py).
+
+MyCloud pages are ASP.NET forms, so every post carries the state fields (__VIEWSTATE etc.) of the page it is
+posted from, along with the fields recorded from the browser session.
+'''
+
+import html
+import logging
+import os
+import re
+from threading import Lock
+from typing import Callable
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from download_excel_files import DownloadTask, ReportWorker, TaskQueue
+from mycloud_capture import STATE_FIELD, fill, load_capture, url_path
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Workbooks are zip files
+XLSX_MAGIC = b'PK\x03\x04'
+
+
+def hidden_fields(page: str) -> dict:
+    ''' Returns name and value of every hidden input of a page. '''
+
+    fields = {}
+    for tag in re.findall(r'<input[^>]*type=["\']hidden["\'][^>]*>', page, re.IGNORECASE):
+        name = re.search(r'name=["\']([^"\']*)["\']', tag)
+        value = re.search(r'value=["\']([^"\']*)["\']', tag)
+        if name:
+            fields[name.group(1)] = html.unescape(value.group(1)) if value else ''
+    return fields
+
+
+def delta_hidden_fields(delta: str) -> dict:
+    ''' Returns hidden fields updated by the response of an ajax postback, a list of length|type|id|content|. '''
+
+    fields = {}
+    position = 0
+    try:
+        while position < len(delta):
+            length_end = delta.index('|', position)
+            type_end = delta.index('|', length_end + 1)
+            id_end = delta.index('|', type_end + 1)
+            content_end = id_end + 1 + int(delta[position:length_end])
+            if delta[length_end + 1:type_end] == 'hiddenField':
+                fields[delta[type_end + 1:id_end]] = delta[id_end + 1:content_end]
+            position = content_end + 1
+    except ValueError:
+        # Not a delta, e.g. an error page
+        return {}
+    return fields
+
+
+def page_state(response: requests.Response, step: dict, state: dict) -> dict:
+    ''' Returns state fields to post from the page after given response. '''
+
+    if 'X-MicrosoftAjax' in step['headers']:
+        return {**state, **{name: value for (name, value) in delta_hidden_fields(response.text).items()
+                            if STATE_FIELD.match(name)}}
+    return {name: value for (name, value) in hidden_fields(response.text).items() if STATE_FIELD.match(name)}
+
+
+class HttpReportWorker(ReportWorker):
+    ''' Downloads reports of the task queue over its own http session in place of a browser session. '''
+
+    logger = logging.getLogger(__name__)
+    # Connections are pooled across all sessions, each session only keeps its own login cookies
+    _adapter = None
+    _adapter_lock = Lock()
+
+    def __init__(self, data, task_queue: TaskQueue, session_name: str, date_str: str,
+                 on_downloaded: Callable[[str], None] = None):
+        ReportWorker.__init__(self, data, task_queue, session_name, date_str, on_downloaded)
+        self.capture = load_capture(data['http_capture'])
+        # Set to replay against another server, e.g. stub_mycloud.py
+        self.base_url = data.get('http_base_url', self.capture['base_url'])
+        self.timeout = data.get('download_timeout', 300)
+        # State fields of the page the session is on
+        self.state = {}
+
+    @classmethod
+    def adapter(cls, pool_size: int) -> HTTPAdapter:
+        with cls._adapter_lock:
+            if cls._adapter is None:
+                cls._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            return cls._adapter
+
+    def open_session(self, download_dir: str) -> requests.Session:
+        session = requests.Session()
+        session.mount(self.base_url, self.adapter(self.data.get('http_sessions', 8)))
+        return session
+
+    def replay(self, session: requests.Session, steps: list, values: dict, state: dict,
+               download_file: str = None) -> dict:
+        ''' Sends recorded steps with given values, returning state fields of the page they end on.
+        A step answered with the report workbook is streamed to download_file. '''
+
+        for step in steps:
+            url = urljoin(self.base_url, step['path'])
+            data = {**state, **fill(step['fields'], values)} if step['method'] == 'POST' else None
+            response = session.request(step['method'], url, data=data, headers=step['headers'],
+                                       timeout=self.timeout, stream=step['workbook'])
+            response.raise_for_status()
+            if step['workbook']:
+                self.save_workbook(response, download_file)
+                continue
+
+            # Landing elsewhere than the browser did, e.g. back on the login page, means the session is not valid
+            if step['response_path'] and url_path(response.url) != step['response_path']:
+                raise PermissionError(f"{step['method']} {step['path']} ended at {url_path(response.url)} "
+                                      f"instead of {step['response_path']}")
+            state = page_state(response, step, state)
+        return state
+
+    @staticmethod
+    def save_workbook(response: requests.Response, download_file: str):
+        ''' Streams an exported report to download_file. '''
+
+        with response:
+            chunks = response.iter_content(chunk_size=1024 * 1024)
+            first = next(chunks, b'')
+            if not first.startswith(XLSX_MAGIC):
+                raise ValueError(f"Report export returned {response.headers.get('Content-Type')} instead of a workbook")
+            # Writing to a partial file first, so a broken transfer never looks like a finished report
+            with open(download_file + '.part', 'wb') as f:
+                f.write(first)
+                for chunk in chunks:
+                    f.write(chunk)
+        os.replace(download_file + '.part', download_file)
+
+    def setup(self, session: requests.Session, property_name: str) -> dict:
+        ''' Logs in to a property as the browser session did, returns state of the report page. '''
+
+        if property_name not in self.capture['setup']:
+            raise ValueError(f"Capture {self.data['http_capture']} has no setup of {property_name}")
+        return self.replay(session, self.capture['setup'][property_name],
+                           {'username': self.data['username'], 'password': self.data['password']}, {})
+
+    def download_report(self, session: requests.Session, state: dict, start_date: str, end_date: str,
+                        download_file: str) -> dict:
+        ''' Exports report of given dates to download_file, returns state of the report page after it. '''
+
+        return self.replay(session, self.capture['export'], {'start_date': start_date, 'end_date': end_date},
+                           state, download_file)
+
+    def login(self, session: requests.Session, task: DownloadTask):
+        session.cookies.clear()
+        self.state = self.setup(session, task.property_name)
+
+    def fetch(self, session: requests.Session, task: DownloadTask, downloaded_file: str, record: dict):
+        self.state = self.download_report(session, self.state, task.start_date, task.end_date, downloaded_file)
+
+    def close_session(self, session: requests.Session):
+        # Session is not closed, that would close connections pooled with other sessions
+        pass
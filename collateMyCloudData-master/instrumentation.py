@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is left out of the report there
+    resource = None
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Report of the run in progress, steps are not recorded if there is none
+_active_report = None
+
+
+def peak_rss_mb():
+    ''' Returns peak resident memory of this process in MB since it started, a high-water mark and not the
+    peak of any one step. '''
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on linux and in bytes on mac
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 2)
+
+
+class RunReport:
+    ''' Collects timing, memory and volume of every stage and sub step of a pipeline run.
+
+    cpu_s of a step is cpu time of the thread running it, so steps of concurrent threads do not count each
+    other's work, and excludes worker threads and processes the step waits on. rss_high_water_mb is the
+    process-wide peak resident memory reached by the time the step ended, not the step's own peak.
+    '''
+
+    def __init__(self, date_str: str, trace_memory: bool = False):
+        self.date_str = date_str
+        self.trace_memory = trace_memory
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self.steps = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.owner_stack = self._stack()
+
+    def _stack(self) -> list:
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def _parent(self):
+        # Steps started from worker threads are nested under the step running in the thread owning the report
+        stack = self._stack()
+        if stack:
+            return stack[-1]
+        return self.owner_stack[-1] if self.owner_stack else None
+
+    @contextmanager
+    def step(self, name: str, **extra):
+        ''' Measures the enclosed block. Yields the record so caller can add rows and bytes to it. '''
+
+        parent = self._parent()
+        record = {'name': name, 'path': f"{parent['path']}/{name}" if parent else name}
+        record.update(extra)
+        stack = self._stack()
+        stack.append(record)
+
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = round(time.perf_counter() - wall, 4)
+            record['cpu_s'] = round(time.thread_time() - cpu, 4)
+            record['rss_high_water_mb'] = peak_rss_mb()
+            if self.trace_memory:
+                # Child steps reset the peak, so carrying their peaks up to the parent
+                peak = max(tracemalloc.get_traced_memory()[1], record.pop('_traced_peak', 0))
+                record['tracemalloc_peak_mb'] = round(peak / (1024 * 1024), 2)
+                if parent is not None:
+                    parent['_traced_peak'] = max(parent.get('_traced_peak', 0), peak)
+            stack.pop()
+            with self.lock:
+                self.steps.append(record)
+
+    def record(self, name: str, **values):
+        ''' Adds a step measured elsewhere, e.g. in a worker process. '''
+
+        parent = self._parent()
+        record = {'name': name, 'path': f"{parent['path']}/{name}" if parent else name}
+        record.update(values)
+        with self.lock:
+            self.steps.append(record)
+
+    def write(self, path: str):
+        ''' Saves report as json file. '''
+
+        report = {'date': self.date_str, 'started': self.started,
+                  'finished': datetime.now().isoformat(timespec='seconds'),
+                  'peak_rss_mb': peak_rss_mb(), 'steps': self.steps}
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        logger.info(f"Saved run report to {path}")
+
+
+def start_run(date_str: str, config: dict) -> RunReport:
+    ''' Starts recording steps of a pipeline run. '''
+
+    global _active_report
+    _active_report = RunReport(date_str, config.get('trace_memory', False))
+    if _active_report.trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return _active_report
+
+
+def finish_run(config: dict):
+    ''' Writes report of current run into the day's directory and stops recording. '''
+
+    global _active_report
+    report, _active_report = _active_report, None
+    if report is None:
+        return
+    if report.trace_memory:
+        tracemalloc.stop()
+    out_dir = os.path.join(config['download_dir'], report.date_str)
+    os.makedirs(out_dir, exist_ok=True)
+    report.write(os.path.join(out_dir, f"{report.date_str}_run_report.json"))
+
+
+@contextmanager
+def step(name: str, **extra):
+    ''' Measures enclosed block as a step of current run, if one was started. '''
+
+    if _active_report is None:
+        yield {}
+        return
+    with _active_report.step(name, **extra) as record:
+        yield record
+
+
+def record_step(name: str, **values):
+    if _active_report is not None:
+        _active_report.record(name, **values)
+
+
+def file_size(*paths) -> int:
+    ''' Returns total size in bytes of given files that exist. '''
+
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
@@ -1,34 +1,107 @@
 ''' Run this file to finally upload all files to Google Cloud Storage bucket. '''
 
+import argparse
 import logging
 from datetime import datetime
 
+import instrumentation
+from checkpoints import STAGES, Checkpoints, file_fingerprints, settings_fingerprint
 from collate_data import main as collate_main
+from collate_data import output_files as collate_outputs
+from columnar_cache import columnar_path
 from download_excel_files import main as download_main
+from output_codec import find_output
+from pipeline import run_pipelined
+from pipeline_context import PipelineContext
+from process_delta import delta_file
 from process_delta import main as delta_main
-from upload_files import upload_all_files
+from upload_files import csv_uploads, upload_all_files
 from verify_download import main as verify_main
+from verify_download import workbook_files
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
+def run_stage(checkpoints: Checkpoints, stage: str, inputs: dict, run, outputs=lambda: ()):
+    ''' Runs a stage unless its checkpoint is still valid, and checkpoints it once it succeeded. '''
+
+    with instrumentation.step(stage) as record:
+        if checkpoints.is_done(stage, inputs):
+            logger.info(f"Skipping {stage} stage, its checkpoint is still valid")
+            record['skipped'] = True
+            return
+        run()
+    checkpoints.save(stage, inputs, outputs())
+
+
+def download(context: PipelineContext):
+    failed = download_main(context.date_str, data=context.config)
+    if failed:
+        raise RuntimeError(f"Could not download {len(failed)} reports for {context.date_str}")
+
+
+def stage_inputs(stage: str, config: dict, files: dict) -> dict:
+    ''' Returns fingerprints of a stage's input files along with the settings its outputs depend on. '''
+
+    return {**files, 'config': settings_fingerprint(stage, config)}
+
+
+def consolidated_files(context: PipelineContext, date_str: str) -> list:
+    path = context.consolidated_file(date_str)
+    return [find_output(path), columnar_path(path)]
+
+
 if __name__ == '__main__':
-    
+    parser = argparse.ArgumentParser(description='Downloads, collates and uploads reports of a day, '
+                                                 'resuming at the first stage not finished yet.')
+    parser.add_argument('--date', default=datetime.today().strftime("%Y-%m-%d"), help='report date, YYYY-MM-DD')
+    parser.add_argument('--force', nargs='+', default=[], choices=STAGES + ['all'],
+                        help='stages to run even if their checkpoint is valid')
+    args = parser.parse_args()
+
     # Settings date string
-    date_str = datetime.today().strftime("%Y-%m-%d")
-    
-    # Downloading excel files
-    download_main(date_str)
-
-    # Verifying downloaded files
-    verify_main(date_str)
-    
-    # Creating csv files and uploading it
-    collate_main(date_str)
-
-    # Processing collate data 
-    delta_main(date_str)
-
-    # Uploading all files to Google Cloud Storage
-    upload_all_files(date_str)
+    date_str = args.date
+
+    # Reading config file once, stages hand their data to the next ones through the context
+    context = PipelineContext(date_str)
+    config = context.config
+    checkpoints = Checkpoints(date_str, config, args.force)
+    if config.get('run_report', True):
+        instrumentation.start_run(date_str, config)
+
+    try:
+        download_inputs = {'config': settings_fingerprint('download', config)}
+        if config.get('pipelined', False) and not checkpoints.is_done('download', download_inputs):
+            # Downloading, verifying and collating with workbooks parsed while others download
+            run_pipelined(context)
+            workbooks = file_fingerprints(workbook_files(date_str, config))
+            checkpoints.save('download', download_inputs, list(workbooks))
+            checkpoints.save('verify', stage_inputs('verify', config, workbooks))
+            checkpoints.save('collate', stage_inputs('collate', config, workbooks), collate_outputs(date_str, config))
+        else:
+            # Downloading excel files
+            run_stage(checkpoints, 'download', download_inputs, lambda: download(context),
+                      lambda: workbook_files(date_str, config))
+
+            # Verifying downloaded files
+            workbooks = file_fingerprints(workbook_files(date_str, config))
+            run_stage(checkpoints, 'verify', stage_inputs('verify', config, workbooks),
+                      lambda: verify_main(date_str, context))
+            
+            # Creating csv files and uploading it
+            run_stage(checkpoints, 'collate', stage_inputs('collate', config, workbooks),
+                      lambda: collate_main(date_str, context=context), lambda: collate_outputs(date_str, config))
+
+        # Processing collate data 
+        delta_inputs = stage_inputs('delta', config, file_fingerprints(
+            consolidated_files(context, date_str) + consolidated_files(context, context.previous_date)))
+        run_stage(checkpoints, 'delta', delta_inputs, lambda: delta_main(date_str, context),
+                  lambda: [find_output(delta_file(config['download_dir'], date_str))])
+
+        # Uploading all files to Google Cloud Storage
+        upload_inputs = stage_inputs('upload', config, file_fingerprints(
+            [path for (blob_name, path) in csv_uploads(date_str, config)]))
+        run_stage(checkpoints, 'upload', upload_inputs, lambda: upload_all_files(date_str, context))
+    finally:
+        instrumentation.finish_run(config)
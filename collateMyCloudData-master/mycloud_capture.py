@@ -0,0 +1,118 @@
+''' Requests of the browser flow, recorded from a Chrome session and replayed by the http fetcher.
+
+A capture holds the document and ajax requests the browser sent to MyCloud while setting up a session on each
+property and while exporting one month's report, with credentials and report dates replaced by placeholders:
+
+    {"base_url": "https://live.mycloudhospitality.com",
+     "setup": {"EBH Coorg": [step, ...], ...},
+     "export": [step, ...]}
+
+    step = {"method": "POST", "path": "/Login/Common/Index.aspx", "type": "Document", "headers": {},
+            "fields": {"txtUserNameEmailId": "{username}", ...}, "response_path": "/...", "workbook": false}
+
+ASP.NET state fields (__VIEWSTATE etc.) are left out of the fields, a replay posts the ones of the page it is on.
+Record a capture with `python download_excel_files.py capture mycloud_capture.json`.
+'''
+
+import json
+import re
+from typing import Callable, List
+from urllib.parse import parse_qsl, urlsplit
+
+BASE_URL = 'https://live.mycloudhospitality.com'
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# Values of a task that are filled into the recorded fields on replay
+PLACEHOLDERS = ('username', 'password', 'start_date', 'end_date')
+# Fields the server renders into every page, posted back from the page a request is sent from
+STATE_FIELD = re.compile(r'__(VIEWSTATE\w*|EVENTVALIDATION|PREVIOUSPAGE)$')
+# Request headers of ajax postbacks, the server answers them with a delta instead of a page
+REPLAYED_HEADERS = ('X-MicrosoftAjax', 'X-Requested-With')
+
+
+def url_path(url: str) -> str:
+    ''' Returns path and query of a url, as steps are kept relative to base_url. '''
+
+    parts = urlsplit(url)
+    return parts.path + ('?' + parts.query if parts.query else '')
+
+
+def fill(fields: dict, values: dict) -> dict:
+    ''' Returns recorded fields with placeholders replaced by given values. '''
+
+    filled = {}
+    for name, value in fields.items():
+        for placeholder in PLACEHOLDERS:
+            if placeholder in values:
+                value = value.replace('{%s}' % placeholder, values[placeholder])
+        filled[name] = value
+    return filled
+
+
+def steps_from_log(entries: List[dict], base_url: str, values: dict,
+                   post_data: Callable[[str], str] = None) -> List[dict]:
+    ''' Returns requests to base_url in Chrome performance log entries as capture steps, with given values
+    replaced by placeholders. post_data is asked for bodies Chrome left out of the log. '''
+
+    requests, responses, downloads = {}, {}, []
+    for entry in entries:
+        message = json.loads(entry['message'])['message']
+        params = message.get('params', {})
+        if message['method'] == 'Network.requestWillBeSent':
+            # Redirects are sent again under the same id, the first request is the one to replay
+            if params['requestId'] not in requests and params['request']['url'].startswith(base_url):
+                requests[params['requestId']] = params
+        elif message['method'] == 'Network.responseReceived':
+            responses[params['requestId']] = params['response']
+        elif message['method'] == 'Page.downloadWillBegin':
+            downloads.append(params['url'])
+
+    placeholders = {value: '{%s}' % name for (name, value) in values.items() if value}
+    steps = []
+    for request_id, params in requests.items():
+        request, response = params['request'], responses.get(request_id, {})
+        disposition = response.get('headers', {}).get('Content-Disposition', '')
+        workbook = (response.get('mimeType') == XLSX_CONTENT_TYPE or '.xlsx' in disposition
+                    or request['url'] in downloads)
+        if params.get('type') not in ('Document', 'XHR') and not workbook:
+            continue
+
+        body = request.get('postData')
+        if body is None and request.get('hasPostData') and post_data is not None:
+            body = post_data(request_id)
+        fields = {name: placeholders.get(value, value) for (name, value) in parse_qsl(body or '', keep_blank_values=True)
+                  if not STATE_FIELD.match(name)}
+        steps.append({'method': request['method'], 'path': url_path(request['url']), 'type': params.get('type'),
+                      'headers': {name: value for (name, value) in request.get('headers', {}).items()
+                                  if name in REPLAYED_HEADERS},
+                      'fields': fields,
+                      'response_path': url_path(response['url']) if params.get('type') == 'Document' and response else None,
+                      'workbook': workbook})
+    return steps
+
+
+def check_capture(capture: dict) -> None:
+    ''' Raises ValueError if a capture does not log in to every property or does not export a report. '''
+
+    def has(steps, placeholder):
+        return any('{%s}' % placeholder in value for step in steps for value in step['fields'].values())
+
+    for property_name, steps in capture['setup'].items():
+        if not (has(steps, 'username') and has(steps, 'password')):
+            raise ValueError(f"Setup of {property_name} in capture does not post the username and password")
+    if not (has(capture['export'], 'start_date') and has(capture['export'], 'end_date')):
+        raise ValueError("Export in capture does not post the report dates")
+    if not capture['export'] or not capture['export'][-1]['workbook']:
+        raise ValueError("Export in capture does not end with the report workbook")
+
+
+def load_capture(path: str) -> dict:
+    with open(path) as f:
+        capture = json.load(f)
+    check_capture(capture)
+    return capture
+
+
+def save_capture(capture: dict, path: str) -> None:
+    check_capture(capture)
+    with open(path, 'w') as f:
+        json.dump(capture, f, indent=2)
@@ -0,0 +1,70 @@
+''' Optional compression of the csv files the pipeline writes, chosen by output_codec in config.
+
+Files are written as {name}.csv.gz or {name}.csv.zst next to where the plain csv file would be, while
+the rest of the pipeline keeps using the plain csv path and finds whichever copy exists.
+'''
+
+import gzip
+import io
+import logging
+import os
+
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# File suffix of every codec, the codec name is also the HTTP content-encoding of the file
+CODECS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def codec_path(path: str, codec: str = None) -> str:
+    ''' Returns path of a csv file as written with given codec, unchanged without one. '''
+
+    if not codec:
+        return path
+    if codec not in CODECS:
+        raise ValueError(f"Unknown output_codec {codec}, expected one of {list(CODECS)}")
+    return path + CODECS[codec]
+
+
+def find_output(path: str) -> str:
+    ''' Returns the latest written copy of a csv file among plain and compressed ones, path itself if none exists. '''
+
+    copies = [p for p in [path] + [codec_path(path, codec) for codec in CODECS] if os.path.exists(p)]
+    return max(copies, key=os.path.getmtime) if copies else path
+
+
+def content_encoding(path: str):
+    ''' Returns codec a file was written with, None for plain files. '''
+
+    for codec, suffix in CODECS.items():
+        if path.endswith(suffix):
+            return codec
+    return None
+
+
+def open_output(path: str, mode: str = 'rb'):
+    ''' Opens a plain or compressed file as a binary stream, by its suffix. '''
+
+    codec = content_encoding(path)
+    if codec == 'gzip':
+        # No timestamp in the header, so the same data always gives the same bytes and upload skips still work
+        return gzip.GzipFile(path, mode, mtime=0)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.open(path, mode)
+    return open(path, mode)
+
+
+def write_csv(df: pd.DataFrame, path: str, codec: str = None) -> str:
+    ''' Saves dataframe as csv file with given codec, removing copies of it written with other codecs. '''
+
+    out_path = codec_path(path, codec)
+    with io.TextIOWrapper(open_output(out_path, 'wb'), encoding='utf-8', newline='') as f:
+        df.to_csv(f, index=False)
+    for stale_path in [path] + [codec_path(path, other) for other in CODECS]:
+        if stale_path != out_path and os.path.exists(stale_path):
+            os.remove(stale_path)
+    return out_path
+
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import logging
+import os
+import re
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Bump when the manifest format is no longer compatible with older ones
+MANIFEST_VERSION = 1
+# Bump when parsing writes different partitions for the same workbook, i.e. 2 for compact schema,
+# 3 for footer split and 4 for reading the footer apart from the rows
+PARSE_VERSION = 4
+PARTITION_DIR = 'partitions'
+
+
+def file_hash(path: str) -> str:
+    ''' Returns sha256 of given file's content. '''
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_path(date_str: str, config: dict) -> str:
+    return os.path.join(config['download_dir'], date_str, f"{date_str}_manifest.json")
+
+
+def partition_path(date_str: str, file_name: str, config: dict) -> str:
+    ''' Returns path of the parsed partition for a {property}_{YYYY-MM}.xlsx file. '''
+
+    return os.path.join(config['download_dir'], date_str, PARTITION_DIR,
+                        os.path.splitext(file_name)[0] + '.parquet')
+
+
+def parse_settings(config: dict) -> dict:
+    ''' Returns settings partitions are parsed with, partitions parsed with other settings are not reused. '''
+
+    return {'parse_version': PARSE_VERSION, 'compact_schema': config.get('compact_schema', False)}
+
+
+def load_manifest(date_str: str, config: dict) -> dict:
+    ''' Returns manifest entries of given date, empty if there is no compatible manifest. '''
+
+    path = manifest_path(date_str, config)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        logger.info(f"Ignoring manifest {path} of version {manifest.get('version')}")
+        return {}
+    if manifest.get('settings') != parse_settings(config):
+        logger.info(f"Ignoring manifest {path} parsed with settings {manifest.get('settings')}")
+        return {}
+    return manifest['files']
+
+
+def save_manifest(date_str: str, entries: dict, config: dict) -> None:
+    with open(manifest_path(date_str, config), 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'settings': parse_settings(config), 'files': entries}, f, indent=2)
+
+
+def previous_manifest_date(date_str: str, config: dict):
+    ''' Returns latest date before given date that has a manifest, None if there is none. '''
+
+    # Nothing downloaded yet on a first run
+    if not os.path.isdir(config['download_dir']):
+        return None
+    dates = [d for d in os.listdir(config['download_dir'])
+             if re.fullmatch(r'\d{4}-\d{2}-\d{2}', d) and d < date_str
+             and os.path.exists(manifest_path(d, config))]
+    return max(dates) if dates else None
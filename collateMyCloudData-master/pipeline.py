@@ -0,0 +1,141 @@
+''' Pipelined run of download and collate stages, parsing each workbook as soon as it is downloaded. '''
+
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
+from threading import Thread
+from typing import List
+
+import instrumentation
+from collate_data import (consolidate, create_summaries, parsed_workbook, previous_partitions, reuse_partition,
+                          timed_read_workbook)
+from download_excel_files import main as download_main
+from partition_manifest import save_manifest
+from pipeline_context import PipelineContext
+from verify_download import WorkbookInfo, get_props_and_dates, probe_workbook, sanity_check, validate_workbook
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class StreamingCollator:
+    ''' Probes, validates and parses workbooks while the rest of them are still being downloaded. '''
+
+    def __init__(self, date_str: str, config: dict):
+        self.date_str = date_str
+        self.config = config
+        self.compact = config.get('compact_schema', False)
+        self.incremental = config.get('incremental_collation', True)
+        self.previous = previous_partitions(date_str, config) if self.incremental else {}
+        # Spawning parse workers, forking while browser session threads run is not safe
+        self.executor = ProcessPoolExecutor(max_workers=max(config.get('parse_workers', 1), 1),
+                                            mp_context=multiprocessing.get_context('spawn'))
+        self.queue = Queue()
+        self.thread = Thread(target=self._consume, name='streaming_collator', daemon=True)
+        # All keyed by file path, so a file downloaded again replaces the earlier one
+        self.workbooks = {}
+        self.entries = {}
+        self.frames = {}
+        self.futures = {}
+        self.errors = []
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, path: str):
+        ''' Called by download sessions once a workbook is moved into the date folder. '''
+
+        self.queue.put(path)
+
+    def _consume(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            try:
+                info = probe_workbook(path)
+                validate_workbook(info)
+                self.workbooks[path] = info
+                self.frames.pop(path, None)
+                if path in self.futures:
+                    self.futures.pop(path).cancel()
+
+                frame = None
+                if self.incremental:
+                    self.entries[path], frame = reuse_partition(info, self.previous, self.date_str, self.config)
+                if frame is not None:
+                    self.frames[path] = frame
+                else:
+                    self.futures[path] = self.executor.submit(timed_read_workbook, path, self.compact)
+                logger.info(f"Queued {os.path.basename(path)} for collation")
+            except Exception as e:
+                logger.exception(f"Could not collate {path}")
+                self.errors.append(e)
+
+    def cancel(self):
+        ''' Stops without waiting for queued workbooks, e.g. after downloads failed. '''
+
+        self.queue.put(None)
+        self.thread.join()
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+    def finish(self) -> tuple:
+        ''' Waits for all workbooks to be parsed, checks them together and returns them with their frames. '''
+
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            if self.errors:
+                raise self.errors[0]
+
+            workbooks = [self.workbooks[path] for path in sorted(self.workbooks)]
+            num_of_months = self.config['end_month_offset'] - self.config['start_month_offset'] + 1
+            sanity_check(get_props_and_dates(self.date_str, self.config, workbooks), num_of_months, self.date_str)
+            logger.info("Sanity check passed!")
+
+            # Same order as a sequential run, so the consolidated data does not depend on download order
+            frames = []
+            for info in workbooks:
+                if info.file in self.futures:
+                    frame = parsed_workbook(info, *self.futures[info.file].result())
+                    if self.incremental:
+                        frame.to_parquet(self.entries[info.file]['partition'], index=False)
+                else:
+                    frame = self.frames[info.file]
+                frames.append(frame)
+        finally:
+            self.executor.shutdown(wait=True)
+
+        if self.incremental:
+            save_manifest(self.date_str, {os.path.basename(path): entry for (path, entry) in self.entries.items()},
+                          self.config)
+        return workbooks, frames
+
+
+def run_pipelined(context: PipelineContext) -> List[WorkbookInfo]:
+    ''' Downloads, verifies and collates a day's workbooks with parsing overlapping the downloads. '''
+
+    date_str, config = context.date_str, context.config
+    collator = StreamingCollator(date_str, config)
+    collator.start()
+    try:
+        with instrumentation.step('download'):
+            failed = download_main(date_str, collator.submit, config)
+        # Consolidating the reports that did download would publish data missing those that did not
+        if failed:
+            raise RuntimeError(f"Could not download {len(failed)} reports for {date_str}")
+    except Exception:
+        collator.cancel()
+        raise
+
+    # Final concat, summaries and delta have to wait for every partition
+    with instrumentation.step('collate'):
+        context.workbooks, frames = collator.finish()
+        context.consolidated = consolidate(frames, date_str, config)
+        logger.info(f"Created {date_str}_consolidated_data.csv successfully!")
+        create_summaries(date_str, config, df=context.consolidated)
+    return context.workbooks
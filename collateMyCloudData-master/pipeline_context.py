@@ -0,0 +1,58 @@
+''' Config and data of a day's run, handed from stage to stage in memory instead of through files. '''
+
+import json
+import logging
+import os
+from datetime import datetime
+
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+from columnar_cache import columnar_path, read_consolidated
+from output_codec import find_output
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def load_config(path: str = 'config.json') -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+class PipelineContext:
+    ''' Loads config once and keeps what each stage produced for the stages after it. '''
+
+    def __init__(self, date_str: str, config: dict = None):
+        self.date_str = date_str
+        self.config = config if config is not None else load_config()
+        self.previous_date = (datetime.strptime(date_str, '%Y-%m-%d') - relativedelta(days=1)).strftime('%Y-%m-%d')
+        # Set by verify and collate stages, files on disk are only outputs once these are set
+        self.workbooks = None
+        self.consolidated = None
+        self.delta = None
+        self._previous_consolidated = None
+
+    def consolidated_file(self, date_str: str = None) -> str:
+        date_str = date_str or self.date_str
+        return os.path.join(self.config['download_dir'], date_str, f"{date_str}_consolidated_data.csv")
+
+    def load_consolidated(self) -> pd.DataFrame:
+        ''' Returns today's consolidated data, from collate stage of this run or else from disk. '''
+
+        if self.consolidated is None:
+            self.consolidated = read_consolidated(self.consolidated_file(), self.config.get('compact_schema', False))
+        return self.consolidated
+
+    def has_previous(self) -> bool:
+        path = self.consolidated_file(self.previous_date)
+        return self._previous_consolidated is not None or any(
+            os.path.exists(p) for p in (find_output(path), columnar_path(path)))
+
+    def previous_consolidated(self) -> pd.DataFrame:
+        ''' Returns yesterday's consolidated data, read from disk only the first time it is asked for. '''
+
+        if self._previous_consolidated is None:
+            self._previous_consolidated = read_consolidated(self.consolidated_file(self.previous_date),
+                                                            self.config.get('compact_schema', False))
+        return self._previous_consolidated
@@ -1,148 +1,242 @@
+import argparse
 import json
 import logging
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 from dateutil.relativedelta import relativedelta
 
+import instrumentation
+from column_schema import AMOUNT_COLUMNS, concat_frames, parse_date_columns
+from columnar_cache import columnar_path, read_consolidated
+from output_codec import find_output, write_csv
+from pipeline_context import PipelineContext
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
-def process_delta_csv(file1_str: str, file2_str: str, output_date: str, out_dir: str, config):
-    df1 = pd.read_csv(file1_str)
-    df2 = pd.read_csv(file2_str)
+# Columns identifying a reservation and a single charge line of it
+CONF_KEY_COLUMNS = ['Hotel Name', 'Account Id']
+MOD_KEY_COLUMNS = ['Hotel Name', 'Account Id', 'Date', 'Revenue Head', 'Amount Payable', 'Invoice/Bill No.']
+
+
+def row_fingerprint(df: pd.DataFrame, columns: list) -> np.ndarray:
+    ''' Returns a 64-bit hash of given columns for every row of dataframe. '''
+
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
 
-    # Creating path for output dir
-    if not os.path.exists(out_dir):
-        os.mkdir(out_dir)
 
-    # Creating a new column called Operation to indicate different 
-    # dataframe type in single one.
-    df1['Operation'] = ''
-    df2['Operation'] = ''
+def _isin(keys: np.ndarray, other: np.ndarray) -> np.ndarray:
+    ''' Hash table membership test of keys in other. '''
+
+    return pd.Index(keys).isin(other)
+
+
+def compute_delta(df1: pd.DataFrame, df2: pd.DataFrame, output_date: str, config: dict) -> pd.DataFrame:
+    ''' Returns confirmations, cancellations and modifications of today's data (df1) over yesterday's (df2). '''
 
     # To filter out data for end and start of month
     start_date = datetime.strptime(output_date, '%Y-%m-%d').replace(day=1)
     num_of_months = config['end_month_offset'] - config['start_month_offset'] + 1
     end_date = start_date + relativedelta(months=num_of_months)
-    start_date = start_date.strftime('%Y-%m-%d')
-    end_date = end_date.strftime('%Y-%m-%d')
-    df1 = df1[(df1['Date'] >= start_date) & (df1['Date'] < end_date)].copy()
-    df2 = df2[(df2['Date'] >= start_date) & (df2['Date'] < end_date)].copy()
+    df1 = parse_date_columns(df1)
+    df2 = parse_date_columns(df2)
+    df1 = df1[(df1['Date'] >= start_date) & (df1['Date'] < end_date)]
+    df2 = df2[(df2['Date'] >= start_date) & (df2['Date'] < end_date)]
     df1 = df1[df1['Reservation Status'].isin(["IN-HOUSE", "CHECKED OUT", "CONFIRMED"])]
     df2 = df2[df2['Reservation Status'].isin(["IN-HOUSE", "CHECKED OUT", "CONFIRMED"])]
 
-
     # Drop the unnamed column.
-    df1.rename({"Unnamed: 39":"a"}, axis="columns", inplace=True)
-    df1.drop(["a"], axis=1, inplace=True)
-
-    df2.rename({"Unnamed: 39":"a"}, axis="columns", inplace=True)
-    df2.drop(["a"], axis=1, inplace=True)
-
-    # Rename Hotel names
-    # df1['Hotel Name'] = df1['Hotel Name'].replace(['Evolve Back Chikkana Halli Estate, Coorg',
-    #                                                 'Evolve Back Kamalapura Palace, Hampi',
-    #                                                 'Evolve Back Kuruba Safari Lodge, Kabini'],
-    #                                                 ['EBH Coorg', 'EBH Hampi', 'EBH Kabini'])
-    # df2['Hotel Name'] = df2['Hotel Name'].replace(['Evolve Back Chikkana Halli Estate, Coorg',
-    #                                                 'Evolve Back Kamalapura Palace, Hampi',
-    #                                                 'Evolve Back Kuruba Safari Lodge, Kabini'],
-    #                                                 ['EBH Coorg', 'EBH Hampi', 'EBH Kabini'])
-
-    # Creating new column of conf_key
-    df1['conf_key'] = df1['Hotel Name'].astype(str) + df1['Account Id'].astype(str)
-    df2['conf_key'] = df2['Hotel Name'].astype(str) + df2['Account Id'].astype(str)
-
-    # Creating common dataframe b/w today and yesterday
-    conf_common = df1.merge(df2, on=['conf_key'])
-
-    # Creating new confirmations dataframe and saving as csv
-    conf_df = df1[~df1.conf_key.isin(conf_common.conf_key)].copy()
-    conf_df.drop(['conf_key'], axis=1, inplace=True)
+    df1 = df1.drop(columns=["Unnamed: 39"], errors='ignore')
+    df2 = df2.drop(columns=["Unnamed: 39"], errors='ignore')
+
+    # Fingerprinting reservations and checking which of them are present on both days
+    conf1 = row_fingerprint(df1, CONF_KEY_COLUMNS)
+    conf2 = row_fingerprint(df2, CONF_KEY_COLUMNS)
+    conf_common1 = _isin(conf1, conf2)
+    conf_common2 = _isin(conf2, conf1)
+
+    # Creating new confirmations dataframe
+    conf_df = df1[~conf_common1].copy()
     conf_df['Operation'] = 'Confirmation'
 
-    # Creating cancellation dataframe and saving as csv
-    cancel_df = df2[~df2.conf_key.isin(conf_common.conf_key)].copy()
-    cancel_df.drop(['conf_key'], axis=1, inplace=True)
-    cancel_df.loc[:, ['Report Date', 'Operation']] = [output_date, 'Cancellation']
-    cancel_df.iloc[:, 34:39] = cancel_df.iloc[:, 34:39] * -1
-
-    # Creating new column in both dataframe to check for modifications
-    df1['mod_key'] = df1['conf_key'].astype(str) + df1['Account Id'].astype(str) + df1['Date'].astype(str) + \
-                        df1['Revenue Head'].astype(str) + df1['Amount Payable'].astype(str) + \
-                        df1['Invoice/Bill No.'].astype(str)
-
-    df2['mod_key'] = df2['conf_key'].astype(str) + df2['Account Id'].astype(str) + df2['Date'].astype(str) + \
-                        df2['Revenue Head'].astype(str) + df2['Amount Payable'].astype(str) + \
-                        df2['Invoice/Bill No.'].astype(str)
-
-    # Creating mod_common dataframe and getting positive and negative modifications.
-    mod_common = df1.merge(df2, on=['mod_key'])
-    mod_today = df1[~df1.mod_key.isin(mod_common.mod_key) & df1.conf_key.isin(conf_common.conf_key)].copy()
-    mod_yesterday = df2[~df2.mod_key.isin(mod_common.mod_key) & df2.conf_key.isin(conf_common.conf_key)].copy()
-    mod_yesterday.iloc[:, 34:39] = mod_yesterday.iloc[:, 34:39] * -1
-
-    # Exporting dataframes as csv
-    mod_yesterday.drop(['conf_key', 'mod_key'], axis=1, inplace=True)
-    mod_yesterday['Operation'] = 'Modifcation'
-    mod_today.drop(['conf_key', 'mod_key'], axis=1, inplace=True)
+    # Creating cancellation dataframe
+    cancel_df = df2[~conf_common2].copy()
+    cancel_df[AMOUNT_COLUMNS] = cancel_df[AMOUNT_COLUMNS] * -1
+    cancel_df['Operation'] = 'Cancellation'
+
+    # Fingerprinting charge lines and getting positive and negative modifications.
+    mod1 = row_fingerprint(df1, MOD_KEY_COLUMNS)
+    mod2 = row_fingerprint(df2, MOD_KEY_COLUMNS)
+    mod_today = df1[conf_common1 & ~_isin(mod1, mod2)].copy()
     mod_today['Operation'] = 'Modifcation'
+    mod_yesterday = df2[conf_common2 & ~_isin(mod2, mod1)].copy()
+    mod_yesterday[AMOUNT_COLUMNS] = mod_yesterday[AMOUNT_COLUMNS] * -1
+    mod_yesterday['Operation'] = 'Modifcation'
 
-    # Saving single dataframe as join of all 4 dataframes
-    main_df = pd.concat([conf_df, cancel_df, mod_yesterday, mod_today], axis=0)
+    # Single dataframe as join of all 4 dataframes
+    main_df = concat_frames([conf_df, cancel_df, mod_yesterday, mod_today])
     main_df['Report Date'] = output_date
-    main_df.to_csv(os.path.join(out_dir, output_date, f"{output_date}_delta_data.csv"), index=False)
+    return main_df
 
 
-def main(date_str: str):
-    # Loading data path from config.json
-    with open('config.json') as f:
-        config = json.load(f)
+def process_delta_csv(file1_str: str, file2_str: str, output_date: str, out_dir: str, config) -> pd.DataFrame:
+    with instrumentation.step('read_consolidated') as record:
+        df1 = read_consolidated(file1_str, config.get('compact_schema', False))
+        df2 = read_consolidated(file2_str, config.get('compact_schema', False))
+        record['rows_out'] = len(df1) + len(df2)
+
+    return process_delta_frames(df1, df2, output_date, out_dir, config)
+
+
+def process_delta_frames(df1: pd.DataFrame, df2: pd.DataFrame, output_date: str, out_dir: str, config) -> pd.DataFrame:
+    ''' Creates delta csv file of today's data (df1) over yesterday's (df2) and returns its data. '''
+
+    # Creating path for output dir
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+
+    with instrumentation.step('compute_delta', rows_in=len(df1) + len(df2)) as record:
+        main_df = compute_delta(df1, df2, output_date, config)
+        record['rows_out'] = len(main_df)
+
+    out_filename = os.path.join(out_dir, output_date, f"{output_date}_delta_data.csv")
+    with instrumentation.step('write_delta', rows_out=len(main_df)) as record:
+        out_filename = write_csv(main_df, out_filename, config.get('output_codec'))
+        record['bytes_written'] = instrumentation.file_size(out_filename)
+    return main_df
 
+
+def main(date_str: str, context: PipelineContext = None):
+    # Loading data path from config.json unless a run already did
+    if context is None:
+        context = PipelineContext(date_str)
+    config = context.config
     data_dir = config['download_dir']
 
     today = date_str
-    yesterday = (datetime.strptime(date_str, '%Y-%m-%d') - relativedelta(days=1)).strftime('%Y-%m-%d')
-
-    today_file = os.path.join(data_dir, today, f"{today}_consolidated_data.csv")
-    yesterday_file = os.path.join(data_dir, yesterday, f"{yesterday}_consolidated_data.csv")
     
     # Check for yesterday's file
-    if os.path.exists(yesterday_file):
+    if context.has_previous():
         logger.info(f'Working for date: {today}')
-        process_delta_csv(today_file, yesterday_file, today, data_dir, config)
+        # Today's data is kept in memory by collate stage of the same run
+        with instrumentation.step('read_consolidated') as record:
+            df1 = context.load_consolidated()
+            df2 = context.previous_consolidated()
+            record['rows_out'] = len(df1) + len(df2)
+        context.delta = process_delta_frames(df1, df2, today, data_dir, config)
         logger.info(f'Delta csv files created for: {today}')
     else:
             # Check for yesterday's files
         logger.warning("Yesterday's data not available! Skipping delta csv creation.")
 
 
-def main_all():
+def consolidated_file(data_dir: str, date_str: str) -> str:
+    return os.path.join(data_dir, date_str, f"{date_str}_consolidated_data.csv")
+
+
+def delta_file(data_dir: str, date_str: str) -> str:
+    return os.path.join(data_dir, date_str, f"{date_str}_delta_data.csv")
+
+
+def available_dates(data_dir: str, start: str = None, end: str = None) -> list:
+    ''' Returns dates with consolidated data in download data dir, oldest first. '''
+
+    dates = [d for d in os.listdir(data_dir)
+             if re.fullmatch(r'\d{4}-\d{2}-\d{2}', d)
+             and modified_time(consolidated_file(data_dir, d))]
+    return sorted(d for d in dates if (start is None or d >= start) and (end is None or d <= end))
+
+
+def modified_time(path: str) -> float:
+    # Consolidated data is read from its parquet copy when present, so either file counts as input
+    times = [os.path.getmtime(p) for p in (find_output(path), columnar_path(path)) if os.path.exists(p)]
+    return max(times) if times else 0
+
+
+def needs_delta(data_dir: str, yesterday: str, today: str) -> bool:
+    ''' Checks if delta of today is missing or older than consolidated data of either day. '''
+
+    output = find_output(delta_file(data_dir, today))
+    if not os.path.exists(output):
+        return True
+    return os.path.getmtime(output) <= max(modified_time(consolidated_file(data_dir, yesterday)),
+                                           modified_time(consolidated_file(data_dir, today)))
+
+
+def delta_run(dates: list, config: dict) -> list:
+    ''' Creates deltas of consecutive dates in given list, loading each day's consolidated data only once. '''
+
+    data_dir = config['download_dir']
+    compact = config.get('compact_schema', False)
+    yesterday_df = read_consolidated(consolidated_file(data_dir, dates[0]), compact)
+    for yesterday, today in zip(dates, dates[1:]):
+        logger.info(f'Working for date: {today}')
+        today_df = read_consolidated(consolidated_file(data_dir, today), compact)
+        write_csv(compute_delta(today_df, yesterday_df, today, config), delta_file(data_dir, today), config.get('output_codec'))
+        yesterday_df = today_df
+    return dates[1:]
+
+
+def backfill(config: dict, start: str = None, end: str = None, workers: int = 1, force: bool = False) -> list:
+    ''' Creates deltas of all days from start to end that are missing or stale, in a process pool. '''
+
+    data_dir = config['download_dir']
+    dates = available_dates(data_dir, end=end)
+    if start is not None:
+        # Keeping the latest day before start, as the delta of start is taken against it
+        dates = [d for d in dates if d < start][-1:] + [d for d in dates if d >= start]
+    pairs = [(yesterday, today) for (yesterday, today) in zip(dates, dates[1:])
+             if force or needs_delta(data_dir, yesterday, today)]
+    for (yesterday, today) in pairs:
+        gap = (datetime.strptime(today, '%Y-%m-%d') - datetime.strptime(yesterday, '%Y-%m-%d')).days
+        if gap > 1:
+            logger.warning(f"No data for {gap - 1} days before {today}, creating its delta against {yesterday}")
+    logger.info(f"{len(pairs)} of {max(len(dates) - 1, 0)} deltas to create")
+
+    # Joining consecutive pairs into runs, then splitting runs into about one chunk per worker
+    runs = []
+    for (yesterday, today) in pairs:
+        if runs and runs[-1][-1] == yesterday:
+            runs[-1].append(today)
+        else:
+            runs.append([yesterday, today])
+    chunk_size = max(-(-len(pairs) // max(workers, 1)), 1)
+    chunks = [run[x:x + chunk_size + 1] for run in runs for x in range(0, len(run) - 1, chunk_size)]
+
+    created = []
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            for result in executor.map(delta_run, chunks, [config] * len(chunks)):
+                created += result
+    else:
+        for chunk in chunks:
+            created += delta_run(chunk, config)
+    logger.info(f'Done creating {len(created)} delta csv files!')
+    return created
+
+
+def main_all(start: str = None, end: str = None, workers: int = 1, force: bool = False):
     """ To run for all files in download data dir """
     
     # Loading data path from config.json
     with open('config.json') as f:
         config = json.load(f)
 
-    data_dir = config['download_dir']
+    backfill(config, start, end, workers, force)
 
-    file_list = [os.path.join(data_dir, i.split('_')[0], i)
-                    for r, d, f in os.walk(data_dir)
-                    for i in f 
-                    if 'consolidated' in i]
 
-    for x in range(len(file_list)-1):
-        yesterday = file_list[x]
-        today = file_list[x+1]
-        logger.info(f'Working for file: {today}')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Creates delta csv files for a range of report dates.')
+    parser.add_argument('--start', help='first report date, YYYY-MM-DD')
+    parser.add_argument('--end', help='last report date, YYYY-MM-DD')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--force', action='store_true', help='recreate deltas that are up to date')
+    args = parser.parse_args()
 
-        if os.name == 'nt':
-            output_date = today.split('\\')[-2]
-        else:
-            output_date = today.split('/')[-2]
-        
-        process_delta_csv(today, yesterday, output_date, data_dir)
-    logger.info('Done Creating delta csv for all files!')
+    main_all(args.start, args.end, args.workers, args.force)
@@ -0,0 +1,183 @@
+''' Local stand-in for MyCloud answering the requests of a capture of the browser flow, serving fixture workbooks
+to the http fetcher.
+
+    python synthetic_data.py fixtures --date 2021-05-11 --months 12
+    python stub_mycloud.py fixtures/2021-05-11 --port 8081
+
+then set "fetcher": "http" and "http_base_url": "http://127.0.0.1:8081" in config.json. The stub takes the
+username, password and http_capture of config.json, accepts only requests following the capture in order, with
+its fields and the view state the stub sent last, and answers exports with {property}_{YYYY-MM}.xlsx fixtures.
+'''
+
+import argparse
+import json
+import logging
+import os
+import re
+import secrets
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from urllib.parse import parse_qsl
+
+from mycloud_capture import XLSX_CONTENT_TYPE, fill, load_capture
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SESSION_COOKIE = 'ASP.NET_SessionId'
+DATE_PATTERN = r'\d{2}/\d{2}/\d{4}'
+
+
+def fields_match(recorded: dict, posted: dict, values: dict) -> dict:
+    ''' Returns report dates posted in place of placeholders if posted fields are the recorded ones, else None. '''
+
+    dates = {}
+    for name, value in fill(recorded, values).items():
+        if name not in posted:
+            return None
+        # Report dates can be any dates, the fixture of the posted month is served
+        pattern = re.escape(value).replace(re.escape('{start_date}'), f"(?P<start_date>{DATE_PATTERN})")
+        pattern = pattern.replace(re.escape('{end_date}'), f"(?P<end_date>{DATE_PATTERN})")
+        match = re.fullmatch(pattern, posted[name])
+        if match is None:
+            return None
+        dates.update(match.groupdict())
+    return dates
+
+
+class StubMyCloudHandler(BaseHTTPRequestHandler):
+    ''' Keeps a session per cookie with its place in the captured setup and export steps. '''
+
+    config = None
+    capture = None
+    fixture_dir = None
+    sessions = {}
+    lock = Lock()
+
+    def session(self) -> tuple:
+        ''' Returns session id and state of the request's cookie, starting a session if there is none. '''
+
+        cookies = dict(part.strip().split('=', 1) for part in self.headers.get('Cookie', '').split(';') if '=' in part)
+        with self.lock:
+            session_id = cookies.get(SESSION_COOKIE)
+            if session_id not in self.sessions:
+                session_id = secrets.token_hex(8)
+                self.sessions[session_id] = {'property': None, 'expected': self.setup_starts(),
+                                             'view_state': None, 'redirect': None}
+            return session_id, self.sessions[session_id]
+
+    def setup_starts(self) -> list:
+        return [('setup', name, 0) for name in self.capture['setup']]
+
+    def steps(self, flow: str, name: str) -> list:
+        return self.capture['setup'][name] if flow == 'setup' else self.capture['export']
+
+    def send_page(self, step: dict, session_id: str, state: dict):
+        state['view_state'] = secrets.token_hex(16)
+        if 'X-MicrosoftAjax' in step['headers']:
+            # Delta of an ajax postback, length|type|id|content| for every updated part
+            body = f"{len(state['view_state'])}|hiddenField|__VIEWSTATE|{state['view_state']}|".encode()
+            self.send_body(200, 'text/plain; charset=utf-8', body, session_id)
+            return
+        body = (f'<html><body><form method="post"><input type="hidden" name="__VIEWSTATE" value="{state["view_state"]}">'
+                f'</form></body></html>').encode()
+        self.send_body(200, 'text/html; charset=utf-8', body, session_id)
+
+    def send_body(self, status: int, content_type: str, body: bytes, session_id: str = None, location: str = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if location:
+            self.send_header('Location', location)
+        if session_id:
+            self.send_header('Set-Cookie', f"{SESSION_COOKIE}={session_id}; Path=/")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.answer({})
+
+    def do_POST(self):
+        self.answer(dict(parse_qsl(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode(),
+                                   keep_blank_values=True)))
+
+    def answer(self, form: dict):
+        session_id, state = self.session()
+        if self.command == 'GET' and state['redirect'] is not None and self.path == state['redirect']['response_path']:
+            step, state['redirect'] = state['redirect'], None
+            self.send_page(step, session_id, state)
+            return
+        if self.command == 'POST' and form.get('__VIEWSTATE') != state['view_state']:
+            self.send_error(400, 'View state does not match the page posted from')
+            return
+
+        # Setup can start over at any time, e.g. a session logging in to another property
+        values = {'username': self.config['username'], 'password': self.config['password']}
+        matched = []
+        for (flow, name, index) in state['expected'] + [start for start in self.setup_starts()
+                                                          if start not in state['expected']]:
+            step = self.steps(flow, name)[index]
+            dates = fields_match(step['fields'], form, values) if step['method'] == 'POST' else {}
+            if step['method'] == self.command and step['path'] == self.path and dates is not None:
+                matched.append((flow, name, index, dates))
+        if not matched:
+            logger.warning(f"{self.command} {self.path} does not follow the capture")
+            self.send_error(400, 'Request does not follow the captured flow')
+            return
+
+        (flow, name, index, dates) = matched[0]
+        step = self.steps(flow, name)[index]
+        expected = [(f, n, i + 1) for (f, n, i, _) in matched if i + 1 < len(self.steps(f, n))]
+        if flow == 'setup' and index + 1 == len(self.steps(flow, name)):
+            state['property'] = name
+        if state['property'] is not None and not any(f == 'export' for (f, _, _) in expected):
+            # Once set up, a session exports reports again and again
+            expected.append(('export', None, 0))
+        state['expected'] = expected
+
+        if step['workbook']:
+            self.send_fixture(state['property'], dates, session_id)
+        elif step['response_path'] and step['response_path'] != step['path']:
+            state['redirect'] = step
+            self.send_body(302, 'text/html; charset=utf-8', b'', session_id, step['response_path'])
+        else:
+            self.send_page(step, session_id, state)
+
+    def send_fixture(self, property_name: str, dates: dict, session_id: str):
+        if property_name is None or 'start_date' not in dates:
+            self.send_error(403, 'No property set up or no report dates posted')
+            return
+        month = datetime.strptime(dates['start_date'], '%d/%m/%Y').strftime('%Y-%m')
+        fixture = os.path.join(self.fixture_dir, f"{property_name}_{month}.xlsx")
+        if not os.path.exists(fixture):
+            self.send_error(404, f"No report of {property_name} for {month}")
+            return
+        with open(fixture, 'rb') as f:
+            self.send_body(200, XLSX_CONTENT_TYPE, f.read(), session_id)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_stub(config: dict, fixture_dir: str, port: int = 0) -> ThreadingHTTPServer:
+    ''' Returns a stub server listening on given port, any free port if 0, to be run with serve_forever. '''
+
+    StubMyCloudHandler.config = config
+    StubMyCloudHandler.capture = load_capture(config['http_capture'])
+    StubMyCloudHandler.fixture_dir = fixture_dir
+    StubMyCloudHandler.sessions = {}
+    return ThreadingHTTPServer(('127.0.0.1', port), StubMyCloudHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves fixture workbooks like MyCloud report exports.')
+    parser.add_argument('fixture_dir', help='folder of {property}_{YYYY-MM}.xlsx workbooks')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+
+    with open('config.json') as f:
+        config = json.load(f)
+    server = start_stub(config, args.fixture_dir, args.port)
+    logger.info(f"Serving {args.fixture_dir} on http://127.0.0.1:{server.server_port}")
+    server.serve_forever()
@@ -0,0 +1,226 @@
+''' Local query service answering filtered aggregates of the latest consolidated data from a precomputed rollup.
+
+    python summary_service.py query --hotel "EB Kabini" --month-from 2021-05 --month-to 2021-07 --group-by "Market Segment"
+    python summary_service.py serve --port 8080
+    curl "localhost:8080/summary?hotel=EB+Kabini&month_from=2021-05&group_by=Business+Source"
+'''
+
+import argparse
+import json
+import logging
+import os
+import re
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+from collate_data import short_hotel_names
+from columnar_cache import read_consolidated
+from process_delta import consolidated_file, modified_time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Same reservations as the summary files, every revenue head is kept so it can be filtered on
+STATUSES = ['CONFIRMED', 'CHECKED OUT', 'IN-HOUSE']
+# Filters of a query and the rollup column each one applies to
+FILTERS = {'hotel': 'Hotel Name', 'segment': 'Market Segment', 'source': 'Business Source',
+           'revenue_head': 'Revenue Head'}
+DIMENSIONS = ['Hotel Name', 'Month Year', 'Market Segment', 'Business Source', 'Revenue Head']
+
+
+def rollup_path(date_str: str, config: dict) -> str:
+    return os.path.join(config['download_dir'], date_str, f"{date_str}_summary_rollup.parquet")
+
+
+def build_rollup(date_str: str, config: dict) -> pd.DataFrame:
+    ''' Aggregates consolidated data of a report date by all query dimensions and saves it next to it. '''
+
+    df = read_consolidated(consolidated_file(config['download_dir'], date_str))
+    df = df[df['Reservation Status'].isin(STATUSES)]
+    df = df.assign(**{'Hotel Name': short_hotel_names(df['Hotel Name']),
+                      'Month Year': df['Date'].dt.strftime('%Y-%m')})
+    rollup = (df.groupby(DIMENSIONS, dropna=False, observed=True)
+                .agg(Amount=('Amount Payable', 'sum')).reset_index())
+    rollup.to_parquet(rollup_path(date_str, config), index=False)
+    logger.info(f"Built summary rollup of {date_str} with {len(rollup)} rows from {len(df)}")
+    return rollup
+
+
+def load_rollup(date_str: str, config: dict) -> pd.DataFrame:
+    ''' Returns rollup of a report date, building it if it is missing or older than the consolidated data. '''
+
+    path = rollup_path(date_str, config)
+    if os.path.exists(path) and os.path.getmtime(path) > modified_time(consolidated_file(config['download_dir'], date_str)):
+        return pd.read_parquet(path)
+    return build_rollup(date_str, config)
+
+
+def check_query(group_by, filters: dict) -> None:
+    ''' Raises ValueError for filters or dimensions a query can not have. '''
+
+    unknown = (set(filters) - set(FILTERS)) | (set(group_by) - set(DIMENSIONS))
+    if unknown:
+        raise ValueError(f"Unknown filters or dimensions {sorted(unknown)}")
+
+
+class LoadedRollup:
+    ''' Rollup of a report date as loaded. Compared by identity, so cached query results are keyed by the rollup
+    they were read from. '''
+
+    def __init__(self, report_date: str, source_time: float, frame: pd.DataFrame):
+        self.report_date = report_date
+        self.source_time = source_time
+        self.frame = frame
+
+
+class SummaryService:
+    ''' Answers aggregate queries of the latest report date, caching results till a newer date lands or the
+    current one is rerun. '''
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.loaded = None
+        self.lock = Lock()
+        self._cached_query = lru_cache(maxsize=config.get('query_cache_size', 256))(self._query)
+
+    @property
+    def report_date(self) -> str:
+        return self.loaded.report_date if self.loaded is not None else None
+
+    def latest_date(self) -> str:
+        ''' Returns latest report date with consolidated data, only checking dates newer than the current one. '''
+
+        data_dir = self.config['download_dir']
+        report_date = self.report_date
+        dates = [d for d in os.listdir(data_dir)
+                 if re.fullmatch(r'\d{4}-\d{2}-\d{2}', d) and (report_date is None or d > report_date)
+                 and modified_time(consolidated_file(data_dir, d))]
+        return max(dates) if dates else report_date
+
+    def refresh(self) -> LoadedRollup:
+        ''' Switches to a newer report date if one landed, or reloads the current one if it was rerun, dropping
+        cached results of the older data. Returns the rollup to answer from. '''
+
+        loaded = self.loaded
+        latest = self.latest_date()
+        if latest is None:
+            raise FileNotFoundError(f"No consolidated data in {self.config['download_dir']}")
+        source_time = modified_time(consolidated_file(self.config['download_dir'], latest))
+        if loaded is not None and (latest, source_time) == (loaded.report_date, loaded.source_time):
+            return loaded
+        with self.lock:
+            if self.loaded is None or (latest, source_time) != (self.loaded.report_date, self.loaded.source_time):
+                self.loaded = LoadedRollup(latest, source_time, load_rollup(latest, self.config))
+                self._cached_query.cache_clear()
+                logger.info(f"Serving summaries of {latest}")
+            return self.loaded
+
+    def query(self, group_by=('Hotel Name',), month_from: str = None, month_to: str = None, **filters) -> pd.DataFrame:
+        ''' Returns summed Amount by given dimensions of rows matching all filters.
+        Filters are hotel, segment, source and revenue_head, each a value or a list of values,
+        months are inclusive YYYY-MM. '''
+
+        check_query(group_by, filters)
+        loaded = self.refresh()
+        key = tuple(sorted((name, tuple(sorted(values)) if isinstance(values, (list, tuple)) else (values,))
+                           for (name, values) in filters.items() if values))
+        return self._cached_query(loaded, tuple(group_by), month_from, month_to, key).copy()
+
+    def _query(self, loaded: LoadedRollup, group_by: tuple, month_from: str, month_to: str,
+               filters: tuple) -> pd.DataFrame:
+        # Reading the rollup passed in, refresh may swap the service's rollup while a query runs
+        rollup = loaded.frame
+        mask = pd.Series(True, index=rollup.index)
+        if month_from:
+            mask &= rollup['Month Year'] >= month_from
+        if month_to:
+            mask &= rollup['Month Year'] <= month_to
+        for (name, values) in filters:
+            mask &= rollup[FILTERS[name]].isin(values)
+
+        rows = rollup[mask]
+        if not group_by:
+            return pd.DataFrame({'Amount': [round(rows['Amount'].sum(), 2)]})
+        # Only combinations present in the rows, categorical columns would otherwise add every other category
+        return (rows.groupby(list(group_by), dropna=False, observed=True).agg(Amount=('Amount', 'sum'))
+                    .reset_index().round(2))
+
+
+class SummaryRequestHandler(BaseHTTPRequestHandler):
+    ''' GET /summary with query filters as url parameters, answered as json records. '''
+
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/summary':
+            self.send_error(404)
+            return
+        params = parse_qs(url.query)
+        start = time.perf_counter()
+        group_by = [d for value in params.get('group_by', ['Hotel Name']) for d in value.split(',') if d]
+        filters = {name: values for (name, values) in params.items() if name in FILTERS}
+        try:
+            check_query(group_by, filters)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        try:
+            result = self.service.query(group_by=group_by, month_from=params.get('month_from', [None])[0],
+                                        month_to=params.get('month_to', [None])[0], **filters)
+        except FileNotFoundError as e:
+            self.send_error(404, str(e))
+            return
+        except Exception as e:
+            # E.g. a rollup that can not be read, answered so the client is not left without a status
+            logger.exception(f"Could not answer {self.path}")
+            self.send_error(500, str(e))
+            return
+        body = json.dumps({'report_date': self.service.report_date,
+                           'rows': json.loads(result.to_json(orient='records'))}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        logger.info(f"{self.path} answered in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def log_message(self, format, *args):
+        # Requests are logged with their query time in do_GET
+        pass
+
+
+def serve(config: dict, port: int = 8080):
+    SummaryRequestHandler.service = SummaryService(config)
+    SummaryRequestHandler.service.refresh()
+    server = ThreadingHTTPServer(('127.0.0.1', port), SummaryRequestHandler)
+    logger.info(f"Serving summary queries on http://127.0.0.1:{port}/summary")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Answers filtered aggregate queries of the latest consolidated data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='answer queries over http')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    query_parser = subparsers.add_parser('query', help='answer a single query')
+    query_parser.add_argument('--group-by', nargs='*', default=['Hotel Name'], choices=DIMENSIONS)
+    query_parser.add_argument('--month-from', help='first stay month, YYYY-MM')
+    query_parser.add_argument('--month-to', help='last stay month, YYYY-MM')
+    for name in FILTERS:
+        query_parser.add_argument(f"--{name.replace('_', '-')}", nargs='+', dest=name)
+    args = parser.parse_args()
+
+    with open('config.json') as f:
+        config = json.load(f)
+    if args.command == 'serve':
+        serve(config, args.port)
+    else:
+        result = SummaryService(config).query(args.group_by, args.month_from, args.month_to,
+                                              **{name: getattr(args, name) for name in FILTERS})
+        print(result.to_string(index=False))
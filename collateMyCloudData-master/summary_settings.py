@@ -0,0 +1,10 @@
+''' Summary files created from consolidated data, shared by the collate and upload stages without their imports. '''
+
+# Summary files created from consolidated data and the field each one is grouped by
+SUMMARIES = {'department_summary.csv': 'Market Segment', 'executive_summary.csv': 'Business Source'}
+
+
+def configured_summaries(config: dict) -> dict:
+    ''' Returns summary files of config, the default ones if it sets none. '''
+
+    return config.get('summaries', SUMMARIES)
@@ -0,0 +1,196 @@
+''' Writes synthetic Guest Transaction History workbooks laid out like MyCloud exports. '''
+
+import argparse
+import logging
+import os
+import random
+import shutil
+from datetime import datetime, timedelta
+
+from dateutil.relativedelta import relativedelta
+from openpyxl import Workbook
+
+from column_schema import DATA_TYPES
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+HOTELS = [('Evolve Back Kuruba Safari Lodge, Kabini', 'EBH Kabini'),
+          ('Evolve Back Chikkana Halli Estate, Coorg', 'EBH Coorg'),
+          ('Evolve Back Kamalapura Palace, Hampi', 'EBH Hampi')]
+ROOM_TYPES = ['Water Villa', 'Jungle Hut', 'Pool Villa', 'Heritage Suite', 'Private Pool Villa']
+STATUSES = ['CONFIRMED'] * 6 + ['CHECKED OUT'] * 3 + ['IN-HOUSE', 'CANCELLED', 'NO SHOW']
+REVENUE_HEADS = ['ROOM CHARGE', 'MEAL - BREAKFAST', 'MEAL - LUNCH', 'MEAL - DINNER', 'HONEYMOON PACKAGE', 'SPA', 'LAUNDRY']
+MARKET_SEGMENTS = ['FIT', 'Corporate', 'Travel Agent', 'Wedding', 'Complimentary']
+BUSINESS_SOURCES = ['Direct', 'Website', 'Booking.com', 'MakeMyTrip', 'Expedia', 'Walk In']
+CHANNELS = ['PMS', 'Booking Engine', 'Channel Manager']
+RATE_TYPES = ['BAR', 'CP', 'MAP', 'AP', 'Package']
+CITIES = [('Bengaluru', 'Karnataka', 'India'), ('Mumbai', 'Maharashtra', 'India'),
+          ('Chennai', 'Tamil Nadu', 'India'), ('London', 'England', 'United Kingdom')]
+
+
+def month_range(month_start: datetime) -> tuple:
+    return month_start, month_start + relativedelta(months=1) - relativedelta(days=1)
+
+
+def make_rows(rng: random.Random, hotel_name: str, month_start: datetime, num_rows: int, first_account: int) -> list:
+    ''' Returns charge lines of reservations staying in given month, in DATA_TYPES column order. '''
+
+    _, month_end = month_range(month_start)
+    rows = []
+    account_id = first_account
+    while len(rows) < num_rows:
+        account_id += 1
+        nights = rng.randint(1, 4)
+        arrival = month_start + timedelta(days=rng.randint(0, (month_end - month_start).days))
+        departure = arrival + timedelta(days=nights)
+        reserved = arrival - timedelta(days=rng.randint(1, 120), minutes=rng.randint(0, 1439))
+        changed = reserved + timedelta(days=rng.randint(0, 10), minutes=rng.randint(0, 1439))
+        adults, youth, children = rng.randint(1, 3), rng.randint(0, 1), rng.randint(0, 2)
+        city, state, country = rng.choice(CITIES)
+        system_rate = float(rng.randrange(15000, 60000, 500))
+        agreed_rate = round(system_rate * rng.choice([1, 1, 0.9, 0.85]), 2)
+        guest = f"Guest {account_id}"
+        reservation = [hotel_name, f"EXT{account_id}", account_id * 10 + 7, account_id, f"INV/{account_id}",
+                       guest, reserved, rng.choice(['frontdesk', 'reservations', 'web']), arrival, departure,
+                       rng.choice(ROOM_TYPES), str(rng.randint(101, 140)), adults, youth, children,
+                       adults + youth + children, rng.choice(STATUSES), reserved, changed,
+                       f"guest{account_id}@example.com", f"98{account_id:08d}", city, state, country,
+                       'Indian' if country == 'India' else 'British', rng.choice(RATE_TYPES),
+                       rng.choice(CHANNELS), rng.choice(BUSINESS_SOURCES), rng.choice(MARKET_SEGMENTS),
+                       rng.choice(['Regular', 'VIP', 'Repeat']), system_rate, agreed_rate]
+
+        # One charge line per night and revenue head, stopping at month end like the monthly report
+        for night in range(nights):
+            date = arrival + timedelta(days=night)
+            if date > month_end:
+                break
+            for head in ['ROOM CHARGE'] + rng.sample(REVENUE_HEADS[1:], rng.randint(0, 2)):
+                amount = agreed_rate if head == 'ROOM CHARGE' else float(rng.randrange(1500, 9000, 250))
+                discount = round(amount * rng.choice([0, 0, 0, 0.1]), 2)
+                taxable = round(amount - discount, 2)
+                taxes = round(taxable * 0.18, 2)
+                rows.append(reservation + [date, head, amount, discount, taxable, taxes, round(taxable + taxes, 2)])
+    return rows[:num_rows]
+
+
+def mutate_rows(rng: random.Random, rows: list, change_rate: float, first_account: int) -> list:
+    ''' Returns next day's version of rows with cancelled, modified and newly confirmed reservations. '''
+
+    accounts = sorted({row[3] for row in rows})
+    changed = set(rng.sample(accounts, int(len(accounts) * change_rate)))
+    cancelled = set(sorted(changed)[:len(changed) // 3])
+    mutated = []
+    for row in rows:
+        if row[3] in cancelled:
+            continue
+        if row[3] in changed and rng.random() < 0.5:
+            row = row[:34] + [round(row[34] * 1.1, 2), row[35], round(row[36] * 1.1, 2),
+                              round(row[37] * 1.1, 2), round((row[36] + row[37]) * 1.1, 2)]
+        mutated.append(row)
+
+    # Adding new reservations in place of cancelled ones
+    month_start = rows[0][32].replace(day=1) if rows else None
+    if month_start is not None:
+        mutated += make_rows(rng, rows[0][0], month_start, len(rows) - len(mutated), first_account)
+    return mutated
+
+
+def write_workbook(path: str, rows: list, hotel_name: str, hotel_id: str, month_start: datetime) -> None:
+    ''' Writes rows as a Guest_Transaction_History export: info rows, header, data and a totals footer. '''
+
+    date_from, date_to = month_range(month_start)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Guest Transaction History')
+    ws.append(['Guest Transaction History'])
+    ws.append([hotel_name])
+    # Info cell parsed by verify_download: dates at [11:21] and [32:42], hotel id in last 5 characters
+    ws.append([f"Date From: {date_from:%d/%m/%Y} Date To : {date_to:%d/%m/%Y} Hotel Id: {hotel_id}"])
+    ws.append([f"Generated On: {datetime(2021, 1, 1):%d/%m/%Y %H:%M}"])
+    ws.append(list(DATA_TYPES) + [None])
+    totals = [0.0] * 5
+    for row in rows:
+        ws.append(row)
+        for x in range(5):
+            totals[x] += row[34 + x]
+    # Footer carries report totals and the trailing unnamed column of MyCloud exports
+    ws.append(['Total'] + [None] * 33 + [round(total, 2) for total in totals] + [' '])
+    wb.save(path)
+
+
+def generate_day(download_dir: str, date_str: str, properties: dict, num_months: int, rows_per_month: int,
+                 seed: int = 0, start: datetime = None) -> dict:
+    ''' Writes {property}_{YYYY-MM}.xlsx files for a day and returns generated rows by file name.
+    Months begin at start, the month of date_str by default. '''
+
+    day_dir = os.path.join(download_dir, date_str)
+    os.makedirs(day_dir, exist_ok=True)
+    if start is None:
+        start = datetime.strptime(date_str, '%Y-%m-%d').replace(day=1)
+    generated = {}
+    for x, (property_name, (hotel_name, hotel_id)) in enumerate(properties.items()):
+        for month in range(num_months):
+            month_start = start + relativedelta(months=month)
+            rng = random.Random(f"{seed}-{property_name}-{month}")
+            rows = make_rows(rng, hotel_name, month_start, rows_per_month, (x * 100 + month) * 1000000)
+            file_name = f"{property_name}_{month_start:%Y-%m}.xlsx"
+            write_workbook(os.path.join(day_dir, file_name), rows, hotel_name, hotel_id, month_start)
+            generated[file_name] = rows
+    return generated
+
+
+def generate_pair(download_dir: str, date_str: str, properties: dict, num_months: int, rows_per_month: int,
+                  change_rate: float = 0.05, changed_months: int = 3, seed: int = 0) -> tuple:
+    ''' Writes workbooks for the day before given date and for given date with mutations in first months.
+
+    Months past changed_months are copied byte for byte, like MyCloud re-exporting unchanged data.
+    '''
+
+    day = datetime.strptime(date_str, '%Y-%m-%d')
+    previous = (day - relativedelta(days=1)).strftime('%Y-%m-%d')
+    # Both days cover the months of given date, also when the day before falls in the month before
+    start = day.replace(day=1)
+    generated = generate_day(download_dir, previous, properties, num_months, rows_per_month, seed, start)
+
+    day_dir = os.path.join(download_dir, date_str)
+    os.makedirs(day_dir, exist_ok=True)
+    ids = {name: hotel_id for (name, (_, hotel_id)) in properties.items()}
+    for x, (file_name, rows) in enumerate(sorted(generated.items())):
+        property_name, month = file_name[:-len('.xlsx')].rsplit('_', 1)
+        month_start = datetime.strptime(month, '%Y-%m')
+        if month_start >= start + relativedelta(months=changed_months):
+            shutil.copyfile(os.path.join(download_dir, previous, file_name), os.path.join(day_dir, file_name))
+            continue
+        rng = random.Random(f"{seed}-{date_str}-{file_name}")
+        rows = mutate_rows(rng, rows, change_rate, (x + 1) * 10000000000)
+        write_workbook(os.path.join(day_dir, file_name), rows, properties[property_name][0],
+                       ids[property_name], month_start)
+    return previous, date_str
+
+
+def synthetic_properties(count: int) -> dict:
+    ''' Returns {property name: (hotel name, hotel id)} for given number of properties. '''
+
+    properties = {}
+    for x in range(count):
+        hotel_name, property_name = HOTELS[x % len(HOTELS)]
+        if x >= len(HOTELS):
+            hotel_name, property_name = f"{hotel_name} {x}", f"{property_name} {x}"
+        properties[property_name] = (hotel_name, f"{10001 + x:05d}")
+    return properties
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('download_dir')
+    parser.add_argument('--date', default=datetime.today().strftime('%Y-%m-%d'))
+    parser.add_argument('--properties', type=int, default=3)
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--rows', type=int, default=1000, help='rows per workbook')
+    parser.add_argument('--change-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate_pair(args.download_dir, args.date, synthetic_properties(args.properties), args.months,
+                  args.rows, args.change_rate, seed=args.seed)
+    logger.info(f"Generated workbooks for {args.date} and the day before in {args.download_dir}")
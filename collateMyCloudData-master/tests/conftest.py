@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules of the pipeline are imported by name, as when running them from the project folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
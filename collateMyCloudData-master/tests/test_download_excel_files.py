@@ -0,0 +1,25 @@
+''' Download sessions sharing the task queue, without a browser. '''
+
+import download_excel_files
+
+
+def config(tmp_path, **settings):
+    return {'username': 'user', 'password': 'secret', 'properties': {'EBH Coorg': '1', 'EBH Kabini': '3'},
+            'start_month_offset': 0, 'end_month_offset': 1, 'download_dir': str(tmp_path / 'data'),
+            'download_attempts': 2, 'retry_backoff': 0.01, **settings}
+
+
+def test_sessions_that_cannot_start_fail_all_tasks(tmp_path):
+    failed = download_excel_files.main('2021-05-11', data=config(tmp_path, chrome_driver_path=str(tmp_path / 'missing')))
+    assert sorted((task.property_name, task.start_date) for task in failed) == [
+        ('EBH Coorg', '01/05/2021'), ('EBH Coorg', '01/06/2021'),
+        ('EBH Kabini', '01/05/2021'), ('EBH Kabini', '01/06/2021')]
+
+
+def test_unfinished_tasks():
+    tasks = [download_excel_files.DownloadTask('EBH Coorg', '1', start, end)
+             for (start, end) in [('01/05/2021', '31/05/2021'), ('01/06/2021', '30/06/2021')]]
+    task_queue = download_excel_files.TaskQueue(tasks, max_attempts=2, backoff=60)
+    task = task_queue.get()
+    task_queue.retry(task)
+    assert sorted(task_queue.unfinished()) == [tasks[0]._replace(attempt=1), tasks[1]]
@@ -0,0 +1,120 @@
+''' Http fetcher replaying a capture against stub_mycloud.py, and captures recorded from Chrome performance logs.
+
+The capture here is test data shaped like a recording: a login that redirects, a property selection, an ajax
+postback answered with a delta and a report export. It does not stand for MyCloud's actual requests.
+'''
+
+import filecmp
+import json
+import os
+import threading
+
+import pytest
+
+import download_excel_files
+from mycloud_capture import XLSX_CONTENT_TYPE, check_capture, save_capture, steps_from_log
+from stub_mycloud import start_stub
+from synthetic_data import generate_day, synthetic_properties
+
+AJAX = {'X-MicrosoftAjax': 'Delta=true', 'X-Requested-With': 'XMLHttpRequest'}
+
+
+def step(method, path, fields=None, headers=None, response_path=None, workbook=False):
+    return {'method': method, 'path': path, 'type': 'XHR' if headers else 'Document', 'headers': headers or {},
+            'fields': fields or {}, 'response_path': response_path, 'workbook': workbook}
+
+
+def sample_capture(properties: dict) -> dict:
+    def setup(prop_id):
+        return [step('GET', '/Login/Index.aspx', response_path='/Login/Index.aspx'),
+                step('POST', '/Login/Index.aspx', {'txtUser': '{username}', 'txtPassword': '{password}',
+                                                   'btnLogin': 'Login'}, response_path='/Home.aspx'),
+                step('POST', '/Home.aspx', {'__EVENTTARGET': f"grid$select_{prop_id}", '__EVENTARGUMENT': ''},
+                     response_path='/Home.aspx'),
+                step('POST', '/Home.aspx?page=reports', {'txtSearch': 'Guest Transaction'}, AJAX)]
+
+    return {'base_url': 'https://mycloud.invalid',
+            'setup': {name: setup(hotel_id) for (name, (_, hotel_id)) in properties.items()},
+            'export': [step('POST', '/Home.aspx?page=reports', {'cmbDatefrom': '{start_date}'}, AJAX),
+                       step('POST', '/Home.aspx?page=reports', {'cmbDatefrom': '{start_date}', 'cmbDateto': '{end_date}',
+                                                                'btnOkReports': 'OK'}, workbook=True)]}
+
+
+@pytest.fixture
+def stub(tmp_path):
+    properties = synthetic_properties(2)
+    generate_day(str(tmp_path / 'fixtures'), '2021-05-11', properties, 2, 20)
+    capture_file = str(tmp_path / 'capture.json')
+    save_capture(sample_capture(properties), capture_file)
+    config = {'username': 'user', 'password': 'secret', 'http_capture': capture_file,
+              'properties': {name: hotel_id for (name, (_, hotel_id)) in properties.items()},
+              'start_month_offset': 0, 'end_month_offset': 1, 'download_dir': str(tmp_path / 'data'),
+              'fetcher': 'http', 'http_sessions': 3, 'download_attempts': 2, 'retry_backoff': 0.01}
+    # Stub keeps its own copy, so changing the fetcher's config does not change what the stub accepts
+    server = start_stub(dict(config), str(tmp_path / 'fixtures' / '2021-05-11'))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config['http_base_url'] = f"http://127.0.0.1:{server.server_port}"
+    yield config
+    server.shutdown()
+
+
+def test_replays_capture(stub):
+    assert download_excel_files.main('2021-05-11', data=stub) == []
+
+    fixtures = os.path.join(os.path.dirname(stub['download_dir']), 'fixtures', '2021-05-11')
+    downloaded = os.path.join(stub['download_dir'], '2021-05-11')
+    names = sorted(f for f in os.listdir(fixtures))
+    assert sorted(f for f in os.listdir(downloaded)) == names
+    assert all(filecmp.cmp(os.path.join(fixtures, f), os.path.join(downloaded, f), shallow=False) for f in names)
+
+
+def test_wrong_password_fails(stub):
+    stub['password'] = 'wrong'
+    failed = download_excel_files.main('2021-05-11', data=stub)
+    assert len(failed) == 4
+
+
+def test_http_fetcher_needs_capture(stub):
+    del stub['http_capture']
+    with pytest.raises(ValueError, match='http_capture'):
+        download_excel_files.main('2021-05-11', data=stub)
+
+
+def log_entry(method, **params):
+    return {'message': json.dumps({'message': {'method': method, 'params': params}})}
+
+
+def test_steps_from_log():
+    base_url = 'https://mycloud.invalid'
+    values = {'username': 'user', 'password': 'secret', 'start_date': '01/05/2021', 'end_date': '31/05/2021'}
+    entries = [
+        log_entry('Network.requestWillBeSent', requestId='1', type='Document',
+                  request={'url': base_url + '/Login/Index.aspx', 'method': 'POST',
+                           'postData': '__VIEWSTATE=abc&txtUser=user&txtPassword=secret', 'headers': {}}),
+        # Redirect of the login keeps its request id
+        log_entry('Network.requestWillBeSent', requestId='1', type='Document',
+                  request={'url': base_url + '/Home.aspx', 'method': 'GET', 'headers': {}}),
+        log_entry('Network.responseReceived', requestId='1', type='Document',
+                  response={'url': base_url + '/Home.aspx', 'mimeType': 'text/html', 'headers': {}}),
+        log_entry('Network.requestWillBeSent', requestId='2', type='Stylesheet',
+                  request={'url': base_url + '/site.css', 'method': 'GET', 'headers': {}}),
+        log_entry('Network.requestWillBeSent', requestId='3', type='Document',
+                  request={'url': 'https://cdn.invalid/page', 'method': 'GET', 'headers': {}}),
+        log_entry('Network.requestWillBeSent', requestId='4', type='Other',
+                  request={'url': base_url + '/Home.aspx?page=reports', 'method': 'POST', 'hasPostData': True,
+                           'headers': {'X-MicrosoftAjax': 'Delta=true', 'Cookie': 'session'}}),
+        log_entry('Network.responseReceived', requestId='4', type='Other',
+                  response={'url': base_url + '/Home.aspx?page=reports', 'mimeType': XLSX_CONTENT_TYPE, 'headers': {}}),
+    ]
+    bodies = {'4': '__EVENTVALIDATION=x&cmbDatefrom=01%2F05%2F2021&cmbDateto=31%2F05%2F2021'}
+
+    steps = steps_from_log(entries, base_url, values, bodies.get)
+    assert steps == [
+        step('POST', '/Login/Index.aspx', {'txtUser': '{username}', 'txtPassword': '{password}'},
+             response_path='/Home.aspx'),
+        {'method': 'POST', 'path': '/Home.aspx?page=reports', 'type': 'Other',
+         'headers': {'X-MicrosoftAjax': 'Delta=true'},
+         'fields': {'cmbDatefrom': '{start_date}', 'cmbDateto': '{end_date}'}, 'response_path': None, 'workbook': True},
+    ]
+    check_capture({'base_url': base_url, 'setup': {'EBH Kabini': steps[:1]}, 'export': steps[1:]})
+    assert 'secret' not in json.dumps(steps)
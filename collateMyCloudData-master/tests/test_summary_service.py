@@ -0,0 +1,31 @@
+''' Summary queries of consolidated data of synthetic workbooks. '''
+
+import pytest
+
+from collate_data import excel_to_csv
+from summary_service import SummaryService
+from synthetic_data import generate_day, synthetic_properties
+
+
+@pytest.fixture(params=[False, True], ids=['plain', 'compact'])
+def service(tmp_path, request):
+    config = {'download_dir': str(tmp_path), 'start_month_offset': 0, 'end_month_offset': 1,
+              'compact_schema': request.param, 'incremental_collation': False}
+    generate_day(str(tmp_path), '2021-05-11', synthetic_properties(3), 2, 20)
+    excel_to_csv('2021-05-11', config)
+    return SummaryService(config)
+
+
+def test_filtered_query_returns_matching_groups_only(service):
+    hotels = service.query(group_by=['Hotel Name'])
+    assert len(hotels) == 3
+
+    hotel = hotels['Hotel Name'][0]
+    result = service.query(group_by=['Hotel Name'], hotel=hotel)
+    assert result.to_dict('records') == hotels[hotels['Hotel Name'] == hotel].to_dict('records')
+
+
+def test_query_returns_combinations_present_in_data(service):
+    result = service.query(group_by=['Hotel Name', 'Market Segment'])
+    present = service.refresh().frame[['Hotel Name', 'Market Segment']].drop_duplicates()
+    assert len(result) == len(present)
@@ -0,0 +1,118 @@
+''' Uploads against an in-memory bucket with the parts of google.cloud.storage.Bucket the uploads use. '''
+
+import os
+
+import pandas as pd
+import pytest
+
+from output_codec import write_csv
+from upload_files import file_md5, upload_csv, upload_to_bucket
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.md5_hash = None
+        self.content_encoding = None
+        self.content_type = None
+
+    @property
+    def public_url(self):
+        return f"https://storage.googleapis.com/{self.bucket.name}/{self.name}"
+
+    def upload_from_filename(self, filename, content_type=None):
+        self.md5_hash = file_md5(filename)
+        self.content_type = content_type
+        self.bucket.uploads.append(self.name)
+        self.bucket.blobs[self.name] = self
+
+
+class FakeBucket:
+    def __init__(self, name='bucket'):
+        self.name = name
+        self.blobs = {}
+        self.uploads = []
+        self.copies = []
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        return self.blobs.get(name)
+
+    def copy_blob(self, blob, destination_bucket, new_name):
+        source = self.blobs[blob.name]
+        copy = FakeBlob(destination_bucket, new_name)
+        copy.md5_hash, copy.content_encoding, copy.content_type = (
+            source.md5_hash, source.content_encoding, source.content_type)
+        destination_bucket.blobs[new_name] = copy
+        self.copies.append((blob.name, new_name))
+        return copy
+
+
+@pytest.fixture
+def config(tmp_path):
+    return {'download_dir': str(tmp_path), 'summaries': {'executive_summary.csv': 'Market Segment'}}
+
+
+def write_outputs(config, date_str, codec=None, amount=1.0, delta=True):
+    ''' Writes consolidated, summary and optionally delta csv files of a date like collate and delta stages. '''
+
+    date_dir = os.path.join(config['download_dir'], date_str)
+    os.makedirs(date_dir, exist_ok=True)
+    df = pd.DataFrame({'Account Id': [1, 2], 'Amount Payable': [amount, 2.0]})
+    names = ['consolidated_data.csv', 'executive_summary.csv'] + (['delta_data.csv'] if delta else [])
+    return {name: write_csv(df, os.path.join(date_dir, f"{date_str}_{name}"), codec) for name in names}
+
+
+def test_upload_skips_unchanged_content(config):
+    path = write_outputs(config, '2021-05-11')['consolidated_data.csv']
+    bucket = FakeBucket()
+
+    upload_to_bucket(bucket, 'consolidated_data/2021-05-11_consolidated_data.csv', path)
+    upload_to_bucket(bucket, 'consolidated_data/2021-05-11_consolidated_data.csv', path)
+    assert bucket.uploads == ['consolidated_data/2021-05-11_consolidated_data.csv']
+
+    write_outputs(config, '2021-05-11', amount=3.0)
+    upload_to_bucket(bucket, 'consolidated_data/2021-05-11_consolidated_data.csv', path)
+    assert len(bucket.uploads) == 2
+
+
+@pytest.mark.parametrize('codec, encoding', [(None, None), ('gzip', 'gzip')])
+def test_upload_sets_content_encoding(config, codec, encoding):
+    path = write_outputs(config, '2021-05-11', codec)['consolidated_data.csv']
+    bucket = FakeBucket()
+
+    upload_to_bucket(bucket, 'consolidated_data/2021-05-11_consolidated_data.csv', path)
+    blob = bucket.get_blob('consolidated_data/2021-05-11_consolidated_data.csv')
+    assert blob.content_encoding == encoding
+    assert blob.content_type == 'text/csv'
+
+
+def test_upload_csv_copies_current_consolidated(config):
+    write_outputs(config, '2021-05-11', 'gzip')
+    bucket = FakeBucket()
+
+    upload_csv('2021-05-11', config, bucket)
+    assert sorted(bucket.uploads) == ['consolidated_data/2021-05-11_consolidated_data.csv',
+                                      'delta_data/2021-05-11_delta_data.csv',
+                                      'executive_summary/2021-05-11_executive_summary.csv']
+    assert bucket.copies == [('consolidated_data/2021-05-11_consolidated_data.csv',
+                              'current_consolidated_data/consolidated_data.csv')]
+    current = bucket.get_blob('current_consolidated_data/consolidated_data.csv')
+    assert current.content_encoding == 'gzip'
+
+    # Rerun with the same files neither uploads nor copies again
+    upload_csv('2021-05-11', config, bucket)
+    assert len(bucket.uploads) == 3
+    assert len(bucket.copies) == 1
+
+
+def test_upload_csv_without_delta(config):
+    write_outputs(config, '2021-05-11', delta=False)
+    bucket = FakeBucket()
+
+    upload_csv('2021-05-11', config, bucket)
+    assert 'delta_data/2021-05-11_delta_data.csv' not in bucket.uploads
+    assert len(bucket.uploads) == 2
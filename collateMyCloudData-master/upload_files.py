@@ -1,55 +1,111 @@
-import json
+import base64
+import hashlib
 import logging
+import mimetypes
 import os
+from concurrent.futures import ThreadPoolExecutor
 
+from google.auth.credentials import AnonymousCredentials
 from google.cloud import storage
 
+import instrumentation
+from output_codec import content_encoding, find_output
+from pipeline_context import PipelineContext
+from summary_settings import configured_summaries
+
 logger = logging.getLogger(__name__)
 
 
-def upload_to_bucket(blob_name: str, path_to_file: str, bucket_name: str, cred_file_path: str):
-    ''' Uploads given file to given google cloud bucket. '''
+def get_bucket(config: dict) -> storage.Bucket:
+    ''' Returns a bucket handle to be shared by all uploads of a run. '''
+
+    # Local GCS emulators (e.g. fake-gcs-server) are picked up by the client from STORAGE_EMULATOR_HOST
+    if os.environ.get('STORAGE_EMULATOR_HOST'):
+        storage_client = storage.Client(project=config.get('gcp_project', 'test'), credentials=AnonymousCredentials())
+    else:
+        storage_client = storage.Client.from_service_account_json(config['google_cloud_cred'])
+    return storage_client.get_bucket(config['bucket_name'])
+
+
+def file_md5(path_to_file: str) -> str:
+    ''' Returns base64 encoded md5 of given file, as reported by Cloud Storage. '''
+
+    digest = hashlib.md5()
+    with open(path_to_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode()
+
+
+def upload_to_bucket(bucket: storage.Bucket, blob_name: str, path_to_file: str) -> str:
+    ''' Uploads given file to given google cloud bucket, unless the same content is already there. '''
 
-    storage_client = storage.Client.from_service_account_json(cred_file_path)
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    blob.upload_from_filename(path_to_file)
-    return blob.public_url
+    with instrumentation.step('upload', blob=blob_name) as record:
+        blob = bucket.get_blob(blob_name)
+        if blob is not None and blob.md5_hash == file_md5(path_to_file):
+            logger.info(f"Skipping {blob_name}, remote copy is up to date")
+            record['skipped'] = True
+            return blob.public_url
 
+        # Compressed files keep the blob's own content type, so consumers are served the plain file
+        blob = bucket.blob(blob_name)
+        blob.content_encoding = content_encoding(path_to_file)
+        blob.upload_from_filename(path_to_file, content_type=mimetypes.guess_type(blob_name)[0])
+        record['bytes_written'] = instrumentation.file_size(path_to_file)
+        logger.info(f"Completed Uploading {blob_name}")
+        return blob.public_url
+
+
+def csv_uploads(date_str: str, config: dict) -> list:
+    ''' Returns blob name and local path of every file to upload for given date, consolidated data first. '''
 
-def upload_csv(date_str: str, config: dict):
     path_name = os.path.join(config['download_dir'], date_str, date_str)
 
-    # To upload all 3 files to same directory
-    upload_to_bucket(f'consolidated_data/{date_str}_consolidated_data.csv',
-                        f'{path_name}_consolidated_data.csv', config['bucket_name'], config['google_cloud_cred'])
-    logger.info(f"Completed Uploading Consolidated Data for {date_str}")
-    upload_to_bucket(f'department_summary/{date_str}_department_summary.csv',
-                        f'{path_name}_department_summary.csv', config['bucket_name'], config['google_cloud_cred'])
-    logger.info(f"Completed Uploading Department Summary for {date_str}")
-    upload_to_bucket(f'executive_summary/{date_str}_executive_summary.csv',
-                        f'{path_name}_executive_summary.csv', config['bucket_name'], config['google_cloud_cred'])
-    logger.info(f"Completed Uploading Executive Summary for {date_str}")
-
-    # To upload latest consolidated data to another directory
-    upload_to_bucket('current_consolidated_data/consolidated_data.csv',
-                        f'{path_name}_consolidated_data.csv', config['bucket_name'], config['google_cloud_cred'])
-    logger.info(f"Completed Uploading Current Consolidated for {date_str}")
+    # Consolidated data and all summaries go to a directory of their own
+    consolidated_blob = f'consolidated_data/{date_str}_consolidated_data.csv'
+    consolidated_file = find_output(f'{path_name}_consolidated_data.csv')
+    uploads = [(consolidated_blob, consolidated_file)]
+    for output_file_name in configured_summaries(config):
+        summary_name = os.path.splitext(output_file_name)[0]
+        uploads.append((f'{summary_name}/{date_str}_{output_file_name}', find_output(f'{path_name}_{output_file_name}')))
 
     # To upload delta_data csv file
-    if os.path.exists(f"{path_name}_delta_data.csv"):
-        upload_to_bucket(f'delta_data/{date_str}_delta_data.csv',
-                            f"{path_name}_delta_data.csv", config['bucket_name'], config['google_cloud_cred'])
-        logger.info(f"Completed Uploading Delta for {date_str}")
-    else:
+    delta_file = find_output(f"{path_name}_delta_data.csv")
+    if os.path.exists(delta_file):
+        uploads.append((f'delta_data/{date_str}_delta_data.csv', delta_file))
+    return uploads
+
+
+def upload_csv(date_str: str, config: dict, bucket: storage.Bucket = None):
+    if bucket is None:
+        bucket = get_bucket(config)
+    uploads = csv_uploads(date_str, config)
+    (consolidated_blob, consolidated_file) = uploads[0]
+    if not any(blob_name.startswith('delta_data/') for (blob_name, _) in uploads):
         logger.info(
             "Delta data file not uploaded cause it's not present in required folder.")
 
+    with ThreadPoolExecutor(max_workers=config.get('upload_workers', 4)) as executor:
+        futures = [executor.submit(upload_to_bucket, bucket, blob_name, path) for (blob_name, path) in uploads]
+        for future in futures:
+            future.result()
+    logger.info(f"Completed Uploading {len(uploads)} files for {date_str}")
+
+    # To copy latest consolidated data to another directory without uploading it again
+    current_blob = 'current_consolidated_data/consolidated_data.csv'
+    current = bucket.get_blob(current_blob)
+    if current is not None and current.md5_hash == file_md5(consolidated_file):
+        logger.info(f"Skipping {current_blob}, remote copy is up to date")
+    else:
+        bucket.copy_blob(bucket.blob(consolidated_blob), bucket, current_blob)
+        logger.info(f"Completed Copying Current Consolidated for {date_str}")
+
 
-def upload_all_files(date_str):
-    # Reading config file
-    with open('config.json') as f:
-        config = json.load(f)
+def upload_all_files(date_str, context: PipelineContext = None):
+    # Reading config file unless a run already did
+    if context is None:
+        context = PipelineContext(date_str)
+    config = context.config
 
     # To upload to Google Cloud Storage
     logger.info("Starting upload of csv files.")
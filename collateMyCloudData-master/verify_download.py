@@ -1,37 +1,143 @@
-import json
 import logging
 import os
+import posixpath
+import re
+import zipfile
 from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple
+from xml.etree import ElementTree
 
-import pandas as pd
 from dateutil.relativedelta import relativedelta
+from openpyxl import load_workbook
+
+from pipeline_context import PipelineContext
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Layout of a Guest_Transaction_History workbook: the info cell sits in the third
+# row, the header in the fifth and the report totals in the last row.
+INFO_ROW = 3
+HEADER_ROWS = 5
+FOOTER_ROWS = 1
+# Namespaces of the xml parts of an xlsx file
+SHEET_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+RELATIONSHIP_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+# Rows are a few KB, so the last one is always within this many bytes of the end of the sheet
+TAIL_BYTES = 1024 * 1024
 
-def get_props_and_dates(date_str: str, config: dict) -> dict:
-    ''' Returns a dictionary of property with details of each excel file. '''
 
-    # Setting up directories
+class WorkbookInfo(NamedTuple):
+    ''' Metadata of a downloaded workbook, read from its first rows only. '''
+    date_from: datetime
+    date_to: datetime
+    file: str
+    hotel_id: str
+    row_count: Optional[int] = None
+
+
+def probe_workbook(file: str) -> WorkbookInfo:
+    ''' Reads hotel id, date range and row count of an excel file without parsing its data. '''
+
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        rows = list(ws.iter_rows(min_row=1, max_row=INFO_ROW, max_col=1, values_only=True))
+        info = str(rows[INFO_ROW - 1][0])
+        # Dimension is read from the sheet's xml header, so this stays cheap.
+        max_row = ws.max_row
+    finally:
+        wb.close()
+
+    dates = re.findall(r'\d{2}/\d{2}/\d{4}', info)
+    assert len(dates) >= 2, f"Could not find report dates in {file}: {info}"
+    row_count = max(max_row - HEADER_ROWS - FOOTER_ROWS, 0) if max_row else None
+
+    return WorkbookInfo(date_from=datetime.strptime(dates[0], "%d/%m/%Y"),
+                        date_to=datetime.strptime(dates[1], "%d/%m/%Y"),
+                        file=file, hotel_id=info[-5:], row_count=row_count)
+
+
+def first_sheet_path(archive: zipfile.ZipFile) -> str:
+    ''' Returns path of the first worksheet's xml inside an xlsx archive. '''
+
+    workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    sheet = workbook.find(f"{{{SHEET_NS}}}sheets/{{{SHEET_NS}}}sheet")
+    relationships = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    target = next(rel.get('Target') for rel in relationships if rel.get('Id') == sheet.get(f"{{{RELATIONSHIP_NS}}}id"))
+    return target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+
+
+def read_last_row(file: str) -> Tuple[int, dict]:
+    ''' Returns row number and numeric cells, by column letter, of the last row of an excel file.
+    Only the end of the sheet is kept while it is decompressed, the rows before it are not parsed. '''
+
+    with zipfile.ZipFile(file) as archive:
+        with archive.open(first_sheet_path(archive)) as f:
+            head = f.read(TAIL_BYTES)
+            tail = head
+            for chunk in iter(lambda: f.read(TAIL_BYTES), b''):
+                tail = tail[-TAIL_BYTES:] + chunk
+
+    # Last row that is not self closing, parsed within the sheet's own root tag for its namespaces
+    root = re.search(rb'<((?:\w+:)?)worksheet\b[^>]*>', head)
+    prefix = root.group(1)
+    end = tail.rfind(b'</' + prefix + b'row>')
+    starts = [m for m in re.finditer(rb'<' + prefix + rb'row\b[^>]*?(/?)>', tail[:end]) if not m.group(1)]
+    if end < 0 or not starts:
+        return 0, {}
+    row = ElementTree.fromstring(root.group(0) + tail[starts[-1].start():end] + b'</' + prefix + b'row></'
+                                 + prefix + b'worksheet>')[0]
+
+    cells = {}
+    for cell in row.iter(f"{{{SHEET_NS}}}c"):
+        value = cell.find(f"{{{SHEET_NS}}}v")
+        if cell.get('t', 'n') == 'n' and value is not None and value.text:
+            cells[re.match(r'[A-Z]+', cell.get('r')).group(0)] = float(value.text)
+    return int(row.get('r')), cells
+
+
+def workbook_files(date_str: str, config: dict) -> List[str]:
+    ''' Returns paths of excel files downloaded on given date, sorted. '''
+
     data_dir = os.path.join(config['download_dir'], date_str)
-    data_files = [os.path.join(data_dir,  f) for f in os.listdir(data_dir) if f.endswith('.xlsx')]
+    if not os.path.exists(data_dir):
+        return []
+    return sorted(os.path.join(data_dir, f) for f in os.listdir(data_dir) if f.endswith('.xlsx'))
+
 
-    # Creating prop dict from excel files
+def probe_workbooks(date_str: str, config: dict) -> List[WorkbookInfo]:
+    ''' Returns a WorkbookInfo for every excel file downloaded on given date. '''
+
+    workbooks = []
+    for file in workbook_files(date_str, config):
+        logger.info(f"Probing File: {file}")
+        workbooks.append(probe_workbook(file))
+    return workbooks
+
+
+def get_props_and_dates(date_str: str, config: dict, workbooks: List[WorkbookInfo] = None) -> dict:
+    ''' Returns a dictionary of property with details of each excel file. '''
+
+    if workbooks is None:
+        workbooks = probe_workbooks(date_str, config)
+
+    # Creating prop dict from probed excel files
     prop_dict = {}
-    for file in data_files:
-        logger.info(f"Opening File: {file}")
-        df = pd.read_excel(file, engine='openpyxl')
-        info = str(df.iloc[1][0])
-        hotel_id = info[-5:]
-        date_from = datetime.strptime(info[11:21], "%d/%m/%Y")
-        date_to = datetime.strptime(info[32:42], "%d/%m/%Y")
-        prop_dict[hotel_id] = prop_dict.get(hotel_id, [])
-        prop_dict[hotel_id].append([date_from, date_to, os.path.basename(file)])
-    
+    for info in workbooks:
+        prop_dict.setdefault(info.hotel_id, []).append(info)
+
     return prop_dict
 
 
+def validate_workbook(info: WorkbookInfo):
+    ''' Checks a single excel file, named {property}_{YYYY-MM}.xlsx, covers the whole month in its name. '''
+
+    month = datetime.strptime(os.path.splitext(os.path.basename(info.file))[0].rsplit('_', 1)[1], "%Y-%m")
+    assert info.date_from == month, "Processing file:" + info.file
+    assert info.date_to == month + relativedelta(months=1) - relativedelta(days=1), "Processing file:" + info.file
+
+
 def sanity_check(prop_dict: dict, num_months: int, start_date):
     ''' Checks all excel files with start and end dates. '''
 
@@ -40,19 +146,25 @@ def sanity_check(prop_dict: dict, num_months: int, start_date):
         logger.info(f"Checking property: {key}")
         value.sort()
         end_date = start_date + relativedelta(months=num_months) - relativedelta(days=1)
-        assert(value[0][0] == start_date)
-        assert (value[len(value)-1][1] == end_date)
+        assert(value[0].date_from == start_date)
+        assert (value[len(value)-1].date_to == end_date)
         for x in range(0, len(value)-1):
-            assert value[x][1] + relativedelta(days=1) == value[x+1][0], "Processing file:" + value[x][2]
+            assert value[x].date_to + relativedelta(days=1) == value[x+1].date_from, "Processing file:" + value[x].file
 
 
-def main(date_str: str):
-    # Reading config file
-    with open('config.json') as f:
-        config = json.load(f)
+def main(date_str: str, context: PipelineContext = None) -> List[WorkbookInfo]:
+    # Reading config file unless a run already did
+    if context is None:
+        context = PipelineContext(date_str)
+    config = context.config
 
-    prop_dict = get_props_and_dates(date_str, config)
+    workbooks = probe_workbooks(date_str, config)
+    prop_dict = get_props_and_dates(date_str, config, workbooks)
     # print(prop_dict)
     num_of_months = config['end_month_offset'] - config['start_month_offset'] + 1
     sanity_check(prop_dict, num_of_months, date_str)
     logger.info("Sanity check passed!")
+
+    # Returning probed workbooks so collation does not have to open them again
+    context.workbooks = workbooks
+    return workbooks